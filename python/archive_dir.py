@@ -7,24 +7,148 @@ import sqlite3
 import mimetypes
 import uuid
 from azure.storage.blob import BlobServiceClient, BlobClient, ContainerClient
-from PIL import Image
-from moviepy import VideoFileClip
+from PIL import Image, ExifTags, features
+from moviepy.config import FFMPEG_BINARY
 import cairosvg
 import time
-import warnings
 import sys
+import io
+import multiprocessing
+import itertools
+import hashlib
+import mmap
+import lzma
+import shutil
+import tarfile
+import json
+import math
+import zlib
+import re
+from xml.etree import ElementTree
+from collections import Counter, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 from dotenv import load_dotenv
 
+# Optional in-process 7z writer for the py7zr compressor backend
+try:
+    import py7zr
+except ImportError:
+    py7zr = None
+
+# Optional Zstandard (pip install zstandard) for the zstd compressor backend
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Optional fast hashes for content deduplication; hashlib.blake2b is used when neither is installed
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
 # Load environment variables from .env file
 load_dotenv()
 
-def get_directory_size(directory):
+HASH_CHUNK_SIZE = 4 * 1024 * 1024
+HASH_MMAP_THRESHOLD = 64 * 1024 * 1024
+LZMA_DICT_SIZE = 32 * 1024 * 1024
+COPY_CHUNK_SIZE = 1024 * 1024
+PACK_DIRECTORY = '_packs'
+MAX_BLOCK_SIZE = 8 * 1024 * 1024
+MAX_SINGLE_PUT_SIZE = 8 * 1024 * 1024
+SCRATCH_LIMIT = 10 * 1024 * 1024 * 1024
+# A pipelined upload is retried this many times, waiting UPLOAD_BACKOFF seconds and twice as long each time after
+UPLOAD_RETRIES = 5
+UPLOAD_BACKOFF = 2.0
+# zstd levels for COMPRESSION_LEVEL 0 to 9; zstd has no store mode, so 0 is its fastest negative level
+ZSTD_LEVELS = [-5, 1, 2, 3, 5, 9, 12, 15, 17, 19]
+ZSTD_THREADS = int(os.getenv('ZSTD_THREADS', '4'))
+ZSTD_THREAD_THRESHOLD = 64 * 1024 * 1024
+# Per-batch zstd dictionary: its size, and the text-like files it is trained on and used for
+ZSTD_DICT_SIZE = 112640
+ZSTD_DICT_FILE_LIMIT = 128 * 1024
+ZSTD_DICT_SAMPLES = 2000
+THUMBNAIL_SIZE = (128, 128)
+THUMBNAIL_MAX_PIXELS = int(os.getenv('THUMBNAIL_MAX_PIXELS', str(50 * 1000 * 1000)))
+
+# Compression methods a policy can choose, as compression levels; 'default' is COMPRESSION_LEVEL
+COMPRESSION_METHODS = {'store': 0, 'fast': 1, 'default': None, 'max': 9}
+
+# Built-in compression policy. Formats that are compressed already are stored, since LZMA gains
+# next to nothing on them. Files that match no rule have their first probe_size bytes checked,
+# and are stored too if their entropy, in bits per byte, reaches entropy_threshold. Any file not
+# stored by then has its first sample_size bytes compressed with a fast codec, and is stored if
+# that leaves store_ratio or more of the sample (0 sample_size turns sampling off).
+DEFAULT_POLICY = {
+    'default': 'default',
+    'content_types': {
+        'image/jpeg': 'store', 'image/png': 'store', 'image/gif': 'store', 'image/webp': 'store', 'image/heic': 'store', 'image/avif': 'store',
+        'video/*': 'store',
+        'audio/mpeg': 'store', 'audio/aac': 'store', 'audio/ogg': 'store', 'audio/flac': 'store', 'audio/mp4': 'store',
+        'application/zip': 'store', 'application/gzip': 'store', 'application/x-7z-compressed': 'store', 'application/x-rar-compressed': 'store',
+        'application/x-xz': 'store', 'application/x-bzip2': 'store', 'application/zstd': 'store',
+    },
+    'extensions': {
+        '.zip': 'store', '.gz': 'store', '.tgz': 'store', '.7z': 'store', '.rar': 'store', '.xz': 'store', '.bz2': 'store', '.zst': 'store',
+        '.docx': 'store', '.xlsx': 'store', '.pptx': 'store', '.odt': 'store', '.ods': 'store', '.jar': 'store', '.apk': 'store',
+        '.heic': 'store', '.mkv': 'store', '.m4a': 'store', '.opus': 'store',
+    },
+    'probe_size': 4096,
+    'entropy_threshold': 7.5,
+    'sample_size': 64 * 1024,
+    'store_ratio': 0.95,
+}
+
+def scan_directory(directory):
+    # Walk the tree once with os.scandir, in the same order as os.walk, keeping each entry's stat result.
+    # Returns a list of (root, dirs, files) with (name, stat) pairs, the item count and the total file size.
+    # A stat that failed is kept as the OSError so the caller can report it.
+    entries = []
+    total_items = 0
     total_size = 0
-    for dirpath, dirnames, filenames in os.walk(directory):
-        for f in filenames:
-            fp = os.path.join(dirpath, f)
-            total_size += os.path.getsize(fp)
-    return total_size
+    stack = [directory]
+    while stack:
+        root = stack.pop()
+        dirs = []
+        files = []
+        subdirs = []
+        try:
+            with os.scandir(root) as it:
+                for entry in it:
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    try:
+                        stat = entry.stat()
+                    except OSError as e:
+                        stat = e
+                    
+                    if is_dir:
+                        dirs.append((entry.name, stat))
+                        # Like os.walk, do not descend into symlinked directories
+                        if not entry.is_symlink():
+                            subdirs.append(entry.path)
+                    else:
+                        files.append((entry.name, stat))
+                        if not isinstance(stat, OSError):
+                            total_size += stat.st_size
+        except OSError:
+            continue
+        
+        entries.append((root, dirs, files))
+        total_items += len(dirs) + len(files)
+        stack.extend(reversed(subdirs))
+    return entries, total_items, total_size
+
+def get_directory_size(directory):
+    return scan_directory(directory)[2]
 
 def format_size(size):
     # Convert size to human-readable format
@@ -33,51 +157,548 @@ def format_size(size):
             return f"{size:.2f} {unit}"
         size /= 1024
 
-def generate_thumbnail(file_path, content_type, conn):
-    thumbnail = None
+def exif_thumbnail(img):
+    # The JPEG preview a camera embeds in IFD1 of the EXIF data, if it covers THUMBNAIL_SIZE and has
+    # the picture's aspect ratio (some cameras letterbox it)
+    exif = img.info.get('exif')
+    if not exif:
+        return None
+    ifd1 = img.getexif().get_ifd(ExifTags.IFD.IFD1)
+    offset = ifd1.get(0x0201)  # JPEGInterchangeFormat
+    length = ifd1.get(0x0202)  # JPEGInterchangeFormatLength
+    if not offset or not length:
+        return None
+    # Offsets count from the TIFF header, which follows the "Exif\0\0" marker in JPEG files
+    if exif.startswith(b'Exif\x00\x00'):
+        offset += 6
+    preview = Image.open(io.BytesIO(exif[offset:offset + length]))
+    if max(preview.size) < max(THUMBNAIL_SIZE) or abs(preview.width / preview.height - img.width / img.height) > 0.02:
+        return None
+    return preview
+
+def image_thumbnail(source):
+    # source is a path or a file object. Decode no more of the image than the thumbnail needs. The size
+    # check is done after draft(), so a huge JPEG that decodes at 1/8 scale is fine while a huge PNG is refused.
+    Image.MAX_IMAGE_PIXELS = None
+    with Image.open(source) as img:
+        preview = exif_thumbnail(img)
+        if preview is not None:
+            img = preview
+        else:
+            # JPEG decodes straight to 1/2, 1/4 or 1/8 scale
+            img.draft(None, (THUMBNAIL_SIZE[0] * 2, THUMBNAIL_SIZE[1] * 2))
+            if img.width * img.height > THUMBNAIL_MAX_PIXELS:
+                raise ValueError(f"Image of {img.width}x{img.height} pixels is over the thumbnail limit of {THUMBNAIL_MAX_PIXELS}")
+        # reducing_gap shrinks by whole factors with reduce() before the final resample
+        img.thumbnail(THUMBNAIL_SIZE, reducing_gap=2.0)
+        return encode_thumbnail(img)
+
+def encode_thumbnail(img):
+    # Returns (data, format, width, height). WebP when Pillow has it, JPEG otherwise; only WebP keeps transparency.
+    has_alpha = 'A' in img.getbands() or 'transparency' in img.info
+    if features.check('webp'):
+        img = img.convert('RGBA' if has_alpha else 'RGB')
+        thumbnail_format = 'webp'
+    else:
+        img = img.convert('RGB')
+        thumbnail_format = 'jpeg'
+    data = io.BytesIO()
+    img.save(data, thumbnail_format, quality=80)
+    return data.getvalue(), thumbnail_format, img.width, img.height
+
+# CSS units an SVG width or height can be given in, as pixels at 96 dpi
+SVG_UNITS = {'': 1.0, 'px': 1.0, 'pt': 4 / 3, 'pc': 16.0, 'mm': 96 / 25.4, 'cm': 96 / 2.54, 'in': 96.0}
+
+def svg_length(value):
+    match = re.fullmatch(r'\s*([0-9.]+(?:e[-+]?[0-9]+)?)\s*([a-z]*)\s*', value or '', re.IGNORECASE)
+    if match is None or match.group(2).lower() not in SVG_UNITS:
+        return None
+    return float(match.group(1)) * SVG_UNITS[match.group(2).lower()]
+
+def svg_output_size(file_path):
+    # cairosvg scales the side it is not given to keep the aspect ratio, so only the longer side of the
+    # document is set to the thumbnail size. The size is the root's width and height, or else its viewBox,
+    # as cairosvg renders it; a document whose proportions cannot be read is set by its width.
     try:
-        if content_type.startswith('image/'):
-            if file_path.lower().endswith('.svg'):
-                # Convert SVG to PNG
-                png_file_path = file_path + '.png'
-                cairosvg.svg2png(url=file_path, write_to=png_file_path)
-                file_path = png_file_path
-            
-            with Image.open(file_path) as img:
-                img.thumbnail((128, 128))
-                thumbnail = img.tobytes()
-        elif content_type.startswith('video/'):
-            with VideoFileClip(file_path) as video:
-                frame = video.get_frame(1)
-                img = Image.fromarray(frame)
-                img.thumbnail((128, 128))
-                thumbnail = img.tobytes()
-    except Exception as e:
-        log_event("Error generating thumbnail", file_path, str(e), conn)
+        _, root = next(ElementTree.iterparse(file_path, events=('start',)))
+    except (ElementTree.ParseError, StopIteration):
+        return {'output_width': THUMBNAIL_SIZE[0]}
+    width, height = svg_length(root.get('width')), svg_length(root.get('height'))
+    viewbox = (root.get('viewBox') or '').replace(',', ' ').split()
+    if not (width and height) and len(viewbox) == 4:
+        width, height = svg_length(viewbox[2]), svg_length(viewbox[3])
+    if width and height and height > width:
+        return {'output_height': THUMBNAIL_SIZE[1]}
+    return {'output_width': THUMBNAIL_SIZE[0]}
+
+def generate_thumbnail(file_path, content_type, timeout=None):
+    thumbnail = None
+    if content_type.startswith('image/'):
+        if file_path.lower().endswith('.svg'):
+            # Rasterize the SVG in memory, already at thumbnail size
+            thumbnail = image_thumbnail(io.BytesIO(cairosvg.svg2png(url=file_path, **svg_output_size(file_path))))
+        else:
+            thumbnail = image_thumbnail(file_path)
+    elif content_type.startswith('video/'):
+        img = video_frame(file_path, timeout)
+        if img is not None:
+            with img:
+                thumbnail = encode_thumbnail(img)
     return thumbnail
 
-def log_event(event_type, file_path, message, conn):
-    retries = 5
-    while retries > 0:
-        try:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO events (id, event_type, file_path, message, timestamp)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (str(uuid.uuid4()), event_type, file_path, message, datetime.now().isoformat()))
-            conn.commit()
+def video_frame(file_path, timeout=None):
+    # Grabs one frame at 1s with a single ffmpeg run instead of opening a VideoFileClip. With -ss before -i
+    # ffmpeg seeks to the nearest keyframe instead of decoding up to it, and the scale filter hands back a
+    # thumbnail-sized PNG. Clips shorter than a second have no frame at 1s, so those are read from the start.
+    scale = f'scale={THUMBNAIL_SIZE[0]}:{THUMBNAIL_SIZE[1]}:force_original_aspect_ratio=decrease'
+    for seek in ('1', '0'):
+        result = subprocess.run([FFMPEG_BINARY, '-nostdin', '-v', 'error', '-ss', seek, '-i', file_path, '-an', '-sn', '-dn',
+                                 '-frames:v', '1', '-vf', scale, '-f', 'image2pipe', '-c:v', 'png', 'pipe:1'],
+                                stdin=subprocess.DEVNULL, capture_output=True, timeout=timeout)
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.decode(errors='replace').strip() or f'ffmpeg exited with status {result.returncode}')
+        if result.stdout:
+            return Image.open(io.BytesIO(result.stdout))
+    return None
+
+def thumbnail_worker(file_path, content_type, timeout=None):
+    # Runs in a ThumbnailStage worker process; the thumbnail is the (data, format, width, height) tuple from
+    # encode_thumbnail() or None, returned with the time spent on it
+    start = time.monotonic()
+    thumbnail = generate_thumbnail(file_path, content_type, timeout)
+    return thumbnail, time.monotonic() - start
+
+def wants_thumbnail(content_type):
+    return content_type is not None and (content_type.startswith('image/') or content_type.startswith('video/'))
+
+class ThumbnailStage:
+    # Generates thumbnails on a process pool so that image and video decoding runs beside the
+    # archive instead of in front of it. Each result is attached to its files row when it arrives.
+    # Results go to the thumbnails table, keyed by file id, so that the files table stays lean.
+    # An item still running after timeout seconds is given up on and logged; its process slot stays
+    # taken until the decoder returns, and once every slot is stuck the pool is replaced. Stuck workers
+    # are killed at close() rather than waited for. Only the writer thread calls into it.
+    def __init__(self, writer, workers=2, timeout=60):
+        self.writer = writer
+        self.workers = workers
+        self.timeout = timeout
+        self.executor = self.new_executor()
+        # (file_id, file_path, content_type) waiting for a free worker
+        self.queue = deque()
+        # future -> (file_id, file_path, content_type, deadline)
+        self.running = {}
+        # Timed out futures whose worker may still be busy
+        self.abandoned = set()
+        # Video thumbnails done, the seconds spent on them and the slowest (seconds, file_path)
+        self.videos = 0
+        self.video_seconds = 0.0
+        self.slowest_video = (0.0, None)
+    
+    def new_executor(self):
+        # Spawned workers, since forking a process that already runs thread pools is not safe
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+    
+    def terminate(self):
+        # Stop the pool without waiting for workers stuck on abandoned items. terminate_workers() is
+        # only in Python 3.14 and later; before that the worker processes are killed directly.
+        if hasattr(self.executor, 'terminate_workers'):
+            self.executor.terminate_workers()
+            return
+        for process in list((self.executor._processes or {}).values()):
+            process.terminate()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+    
+    def replace_executor(self):
+        self.terminate()
+        self.executor = self.new_executor()
+        self.abandoned = set()
+    
+    def submit(self, file_id, file_path, content_type):
+        self.queue.append((file_id, file_path, content_type))
+        self.poll()
+    
+    def poll(self):
+        now = time.monotonic()
+        for future, (file_id, file_path, content_type, deadline) in list(self.running.items()):
+            if future.done():
+                del self.running[future]
+                try:
+                    thumbnail, seconds = future.result()
+                    if content_type.startswith('video/'):
+                        self.videos += 1
+                        self.video_seconds += seconds
+                        self.slowest_video = max(self.slowest_video, (seconds, file_path))
+                    if thumbnail is not None:
+                        self.writer.execute(INSERT_THUMBNAIL_SQL, thumbnail + (file_id,))
+                except Exception as e:
+                    log_event("Error generating thumbnail", file_path, str(e), self.writer)
+            elif now > deadline:
+                del self.running[future]
+                self.abandoned.add(future)
+                log_event("Error generating thumbnail", file_path, f"Timed out after {self.timeout} seconds", self.writer)
+        self.abandoned = {future for future in self.abandoned if not future.done()}
+        if self.queue and not self.running and len(self.abandoned) >= self.workers:
+            # Every worker is stuck on a timed out item; replace the pool rather than wait for one
+            self.replace_executor()
+        
+        # Only hand out items to idle workers, so that the deadline covers decoding and not queueing
+        while self.queue and len(self.running) + len(self.abandoned) < self.workers:
+            file_id, file_path, content_type = self.queue.popleft()
+            # The worker's ffmpeg gets the same timeout, so a hung decoder is killed rather than left behind
+            try:
+                future = self.executor.submit(thumbnail_worker, file_path, content_type, self.timeout)
+            except BrokenProcessPool:
+                # A worker died, e.g. killed for lack of memory or crashed in a decoder. The items it took down
+                # with it fail with BrokenProcessPool and are logged by the next poll; the rest go to a new pool.
+                self.replace_executor()
+                future = self.executor.submit(thumbnail_worker, file_path, content_type, self.timeout)
+            self.running[future] = (file_id, file_path, content_type, time.monotonic() + self.timeout)
+    
+    def drain(self, limit=0):
+        # Block until at most limit items are queued; with limit 0, until every item is done or given up on
+        while len(self.queue) > limit or (not limit and self.running):
+            self.poll()
+            if self.running:
+                next_deadline = min(deadline for _, _, _, deadline in self.running.values())
+                wait(self.running, timeout=max(0, next_deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+    
+    def close(self):
+        self.drain()
+        if self.abandoned:
+            self.terminate()
+        else:
+            self.executor.shutdown()
+        if self.videos:
+            seconds, file_path = self.slowest_video
+            tqdm.write(f"Video thumbnails: {self.videos} in {self.video_seconds:.1f}s, {self.video_seconds / self.videos:.2f}s per video, slowest {seconds:.2f}s ({file_path})")
+
+def open_catalog(db_path):
+    # WAL keeps readers such as search_db.py off the writer's back, and with synchronous=NORMAL
+    # a commit no longer waits for an fsync. Lock waits are left to SQLite's busy timeout.
+    conn = sqlite3.connect(db_path, timeout=60)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    create_tables(conn)
+    return conn
+
+class CatalogWriter:
+    # Buffers catalog writes and runs them with executemany, committing every commit_rows
+    # statements or commit_interval seconds, whichever comes first. Statements keep their order,
+    # and flush() makes buffered rows visible to queries on the same connection without committing.
+    def __init__(self, conn, commit_rows=1000, commit_interval=5.0):
+        self.conn = conn
+        self.commit_rows = commit_rows
+        self.commit_interval = commit_interval
+        self.buffer = []
+        self.uncommitted = 0
+        self.last_commit = time.monotonic()
+    
+    def execute(self, sql, params):
+        self.buffer.append((sql, params))
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_rows or time.monotonic() - self.last_commit >= self.commit_interval:
+            self.commit()
+    
+    def flush(self):
+        cursor = self.conn.cursor()
+        for sql, group in itertools.groupby(self.buffer, key=lambda item: item[0]):
+            cursor.executemany(sql, [params for _, params in group])
+        self.buffer = []
+    
+    def commit(self):
+        self.flush()
+        self.conn.commit()
+        self.uncommitted = 0
+        self.last_commit = time.monotonic()
+
+INSERT_EVENT_SQL = '''
+    INSERT INTO events (id, event_type, file_path, message, timestamp)
+    VALUES (?, ?, ?, ?, ?)
+'''
+
+def log_event(event_type, file_path, message, writer):
+    writer.execute(INSERT_EVENT_SQL, (str(uuid.uuid4()), event_type, file_path, message, datetime.now().isoformat()))
+
+INSERT_THUMBNAIL_SQL = '''
+    INSERT OR REPLACE INTO thumbnails (data, format, width, height, file_id)
+    VALUES (?, ?, ?, ?, ?)
+'''
+
+INSERT_DICTIONARY_SQL = '''
+    INSERT INTO dictionaries (id, batch, created, dict_id, data) VALUES (?, ?, ?, ?, ?)
+'''
+
+# A files record as INSERT_FILE_SQL writes it; its columns are named after the fields, and uploaded starts at 0.
+# Thumbnails live in their own table, so the thumbnail column is left NULL.
+FileRow = namedtuple('FileRow', ['id', 'filename', 'filepath', 'content_type', 'size', 'creation_time', 'modification_time', 'original_path', 'batch',
+                                 'source_path', 'creation_time_ns', 'modification_time_ns', 'is_duplicate', 'content_hash', 'pack_id', 'member_name',
+                                 'compression_method', 'sample_ratio', 'dictionary_id', 'original_id'],
+                     defaults=(0, None, None, None, None, None, None, None))
+
+INSERT_FILE_SQL = f'''
+    INSERT INTO files ({', '.join(FileRow._fields)}, uploaded)
+    VALUES ({', '.join('?' * len(FileRow._fields))}, 0)
+'''
+
+def new_content_hasher():
+    # Fastest available hash; the name is stored with the digest so hashes from different algorithms never match
+    if blake3 is not None:
+        return 'blake3', blake3.blake3()
+    if xxhash is not None:
+        return 'xxh3', xxhash.xxh3_128()
+    return 'blake2b', hashlib.blake2b(digest_size=32)
+
+def hash_file(file_path):
+    name, hasher = new_content_hasher()
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size >= HASH_MMAP_THRESHOLD:
+            # Hash big files straight from the page cache instead of copying them through read()
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                hasher.update(data)
+        else:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                hasher.update(chunk)
+    return f"{name}:{hasher.hexdigest()}"
+
+def lzma2_dict_size(file_path):
+    # A dictionary larger than the file gains nothing but still costs the encoder its allocation,
+    # which dominates for small files. 4 KiB is the LZMA2 minimum.
+    return min(LZMA_DICT_SIZE, max(os.path.getsize(file_path), 4096))
+
+def compress_with_7z(file_path, archive_path, level):
+    # Level 0 stores the file; an explicit -m0=LZMA2 would otherwise still compress it
+    methods = ['-m0=Copy'] if level == 0 else ['-m0=LZMA2', '-md=32m']
+    subprocess.run(['7z', 'a', '-t7z', f'-mx={level}'] + methods + ['-ms=64m', '-mmt=4', '-bd', archive_path, file_path], 
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+
+def compress_with_xz(file_path, archive_path, level):
+    # LZMA2 in an .xz container, streamed in-process. 7z reads .xz directly. The level is used as the
+    # xz preset, which matches 7z's -mx levels except that xz has no store mode for level 0.
+    filters = [{'id': lzma.FILTER_LZMA2, 'preset': level, 'dict_size': lzma2_dict_size(file_path)}]
+    with open(file_path, 'rb') as src, lzma.open(archive_path, 'wb', format=lzma.FORMAT_XZ, filters=filters) as dst:
+        shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+
+def compress_with_py7zr(file_path, archive_path, level):
+    # In-process .7z with the same LZMA2 settings as the 7z backend; level 0 stores the file like -mx=0
+    if level == 0:
+        filters = [{'id': py7zr.FILTER_COPY}]
+    else:
+        filters = [{'id': py7zr.FILTER_LZMA2, 'preset': level, 'dict_size': lzma2_dict_size(file_path)}]
+    with py7zr.SevenZipFile(archive_path, 'w', filters=filters) as archive:
+        archive.write(file_path, os.path.basename(file_path))
+
+def pack_with_7z(members, archive_path, level, src_dir):
+    # Solid archive whose member names are the paths relative to src_dir. The names go through a
+    # list file so that a large pack stays clear of command line length limits.
+    list_path = archive_path + '.lst'
+    with open(list_path, 'w', encoding='utf-8') as f:
+        for file_path, member_name in members:
+            f.write(os.path.relpath(file_path, src_dir) + '\n')
+    try:
+        subprocess.run(['7z', 'a', '-t7z', f'-mx={level}', '-m0=LZMA2', '-md=32m', '-ms=on', '-mmt=4', '-bd', '-scsUTF-8', os.path.abspath(archive_path), '@' + os.path.abspath(list_path)], 
+                       cwd=src_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    finally:
+        os.remove(list_path)
+
+def pack_with_xz(members, archive_path, level, src_dir):
+    # .tar.xz is a single solid LZMA2 stream and 7z reads it
+    with tarfile.open(archive_path, 'w:xz', preset=level) as archive:
+        for file_path, member_name in members:
+            archive.add(file_path, member_name, recursive=False)
+
+def pack_with_py7zr(members, archive_path, level, src_dir):
+    # py7zr writes solid archives
+    if level == 0:
+        filters = [{'id': py7zr.FILTER_COPY}]
+    else:
+        filters = [{'id': py7zr.FILTER_LZMA2, 'preset': level, 'dict_size': LZMA_DICT_SIZE}]
+    with py7zr.SevenZipFile(archive_path, 'w', filters=filters) as archive:
+        for file_path, member_name in members:
+            archive.write(file_path, member_name)
+
+def compress_with_zstd(file_path, archive_path, level, dictionary=None):
+    # Zstandard at the ZSTD_LEVELS equivalent of the level, with its parameters tuned to the file size.
+    # Files of ZSTD_THREAD_THRESHOLD bytes or more are compressed on ZSTD_THREADS threads, like 7z's -mmt=4.
+    # A dictionary, a zstandard.ZstdCompressionDict, is only worth it for small files.
+    size = os.path.getsize(file_path)
+    if dictionary is not None:
+        compressor = zstandard.ZstdCompressor(level=ZSTD_LEVELS[level], dict_data=dictionary)
+    else:
+        threads = ZSTD_THREADS if size >= ZSTD_THREAD_THRESHOLD else 0
+        compressor = zstandard.ZstdCompressor(compression_params=zstandard.ZstdCompressionParameters.from_level(
+            ZSTD_LEVELS[level], source_size=size, threads=threads, write_content_size=True))
+    with open(file_path, 'rb') as src, open(archive_path, 'wb') as dst:
+        compressor.copy_stream(src, dst, size=size, read_size=COPY_CHUNK_SIZE)
+
+def pack_with_zstd(members, archive_path, level, src_dir):
+    # A tar stream compressed as one zstd frame, which restore_dir.py reads back in one pass
+    compressor = zstandard.ZstdCompressor(compression_params=zstandard.ZstdCompressionParameters.from_level(ZSTD_LEVELS[level], threads=ZSTD_THREADS))
+    with open(archive_path, 'wb') as f, compressor.stream_writer(f) as stream, tarfile.open(fileobj=stream, mode='w|') as archive:
+        for file_path, member_name in members:
+            archive.add(file_path, member_name, recursive=False)
+
+def is_text_like(content_type):
+    return content_type is not None and (content_type.startswith('text/') or content_type.endswith(('+xml', '+json'))
+                                         or content_type in ('application/json', 'application/xml', 'application/javascript', 'image/svg+xml'))
+
+def train_dictionary(entries, pack_threshold, dict_size=ZSTD_DICT_SIZE):
+    # Trains a zstd dictionary on the text-like files of the scan that get an archive of their own and are
+    # small enough for it to help, i.e. those compress_files_and_save_to_db will compress with it. Up to
+    # ZSTD_DICT_SAMPLES of them, spread over the whole tree, are read, about 100 times the dictionary size
+    # in all. Returns (dictionary, number of samples), or (None, 0) when there is too little to train on.
+    candidates = [os.path.join(root, name) for root, _, files in entries for name, stat in files
+                  if not isinstance(stat, OSError) and pack_threshold <= stat.st_size <= ZSTD_DICT_FILE_LIMIT and stat.st_size > 0
+                  and is_text_like(mimetypes.guess_type(name)[0])]
+    stride = max(1, len(candidates) // ZSTD_DICT_SAMPLES)
+    samples = []
+    sample_bytes = 0
+    for file_path in candidates[::stride]:
+        if sample_bytes >= dict_size * 100:
             break
-        except sqlite3.OperationalError as e:
-            if "database is locked" in str(e):
-                retries -= 1
-                time.sleep(1)
+        try:
+            with open(file_path, 'rb') as f:
+                samples.append(f.read(ZSTD_DICT_FILE_LIMIT))
+        except OSError:
+            continue
+        sample_bytes += len(samples[-1])
+    # zstd needs a fair number of samples, and more data than the dictionary it makes
+    if len(samples) < 8 or sample_bytes < dict_size:
+        return None, 0
+    try:
+        return zstandard.train_dictionary(dict_size, samples), len(samples)
+    except zstandard.ZstdError:
+        return None, 0
+
+# Compressor backends: name -> (archive extension, function(file_path, archive_path, level),
+#                                pack extension, function(members, archive_path, level, src_dir))
+COMPRESSORS = {
+    '7z': ('.7z', compress_with_7z, '.7z', pack_with_7z),
+    'xz': ('.xz', compress_with_xz, '.tar.xz', pack_with_xz),
+}
+if py7zr is not None:
+    COMPRESSORS['py7zr'] = ('.7z', compress_with_py7zr, '.7z', pack_with_py7zr)
+if zstandard is not None:
+    COMPRESSORS['zstd'] = ('.zst', compress_with_zstd, '.tar.zst', pack_with_zstd)
+
+def compression_level(method):
+    level = COMPRESSION_METHODS[method]
+    return int(os.getenv('COMPRESSION_LEVEL', '5')) if level is None else level
+
+def load_policy(policy_file=None):
+    # A JSON policy file has any of the keys of DEFAULT_POLICY. Its content_types and extensions add to or
+    # override the built-in rules, so that a rule can be dropped again by mapping it to 'default'.
+    policy = {key: dict(value) if isinstance(value, dict) else value for key, value in DEFAULT_POLICY.items()}
+    if policy_file is not None:
+        with open(policy_file, encoding='utf-8') as f:
+            overrides = json.load(f)
+        for key, value in overrides.items():
+            if key not in policy:
+                raise ValueError(f"Unknown policy setting: {key}")
+            if isinstance(policy[key], dict):
+                policy[key].update({name.lower(): method for name, method in value.items()})
             else:
-                raise
+                policy[key] = value
+    for method in [policy['default']] + list(policy['content_types'].values()) + list(policy['extensions'].values()):
+        if method not in COMPRESSION_METHODS:
+            raise ValueError(f"Unknown compression method in policy: {method}")
+    return policy
 
-def compress_files_and_save_to_db(src_dir, dest_dir, conn, timestamp):
-    cursor = conn.cursor()
+def byte_entropy(data):
+    # Shannon entropy in bits per byte: near 8 for compressed or encrypted data
+    if not data:
+        return 0.0
+    return -sum(count / len(data) * math.log2(count / len(data)) for count in Counter(data).values())
+
+def sample_ratio(data):
+    # Compressed to original size of a sample with zlib at level 1, a cheap estimate of how far the
+    # whole file will shrink; LZMA does somewhat better, so a ratio near 1 means compression is wasted
+    if not data:
+        return None
+    return len(zlib.compress(data, 1)) / len(data)
+
+def choose_method(policy, file_path, content_type):
+    # Returns the compression method and the sample ratio, or None if the file was not sampled.
+    # The extension rule wins, then the exact content type, then its major type such as video/*.
+    # Only a file that matches no rule is probed, and only one that is not stored by then is sampled.
+    # Both read the same first bytes of the file.
+    method = policy['extensions'].get(os.path.splitext(file_path)[1].lower())
+    if method is None and content_type is not None:
+        method = policy['content_types'].get(content_type) or policy['content_types'].get(content_type.split('/')[0] + '/*')
+    if method == 'store' or (method is not None and policy['sample_size'] <= 0):
+        return method, None
     
-    # Create tables
+    with open(file_path, 'rb') as f:
+        head = f.read(max(policy['probe_size'], policy['sample_size']) if method is None else policy['sample_size'])
+    if method is None:
+        method = 'store' if byte_entropy(head[:policy['probe_size']]) >= policy['entropy_threshold'] else policy['default']
+    if method == 'store' or policy['sample_size'] <= 0:
+        return method, None
+    ratio = sample_ratio(head[:policy['sample_size']])
+    if ratio is not None and ratio >= policy['store_ratio']:
+        method = 'store'
+    return method, ratio
+
+def compress_file(file_path, archive_path, compressor='7z', policy=None, content_type=None, dictionary=None):
+    # Compress the file with the chosen backend; runs on a worker thread, which also reads the file's head
+    # to choose its method from policy. Returns the archive size, the method and the sample ratio.
+    if policy is None:
+        policy = load_policy()
+    method, ratio = choose_method(policy, file_path, content_type)
+    # Always write a fresh archive; 7z a would update one left behind by an interrupted run
+    if os.path.exists(archive_path):
+        os.remove(archive_path)
+    if dictionary is None:
+        COMPRESSORS[compressor][1](file_path, archive_path, compression_level(method))
+    else:
+        # Only the zstd backend takes a dictionary
+        compress_with_zstd(file_path, archive_path, compression_level(method), dictionary)
+    return os.path.getsize(archive_path), method, ratio
+
+def pack_files(members, archive_path, compressor, src_dir):
+    # Compress (file_path, member_name) pairs into one solid pack archive; runs on a worker thread.
+    # Packs hold small files of every kind and always use the default level, so like compress_file
+    # this returns the archive size, the method and the sample ratio, which is None.
+    compression_level = int(os.getenv('COMPRESSION_LEVEL', '5'))
+    if os.path.exists(archive_path):
+        os.remove(archive_path)
+    COMPRESSORS[compressor][3](members, archive_path, compression_level, src_dir)
+    return os.path.getsize(archive_path), 'default', None
+
+def write_compressed_file(job, pending_keys, writer, pbar, uploader=None, thumbnails=None):
+    # Wait for a queued compression and save the records of the files in it; only called from the
+    # writer thread. A job is (future, [(key, file_path, content_type, FileRow)]), with several files for
+    # a pack. With an UploadPipeline the archive is queued for upload right away, and with a
+    # ThumbnailStage images and videos are queued for thumbnails. The worker's compression method
+    # and sample ratio go into the rows.
+    # Returns the size of the written archive.
+    future, items = job
+    for key, _, _, _ in items:
+        pending_keys[key] -= 1
+    reserved = sum(row.size for _, _, _, row in items)
+    try:
+        compressed_size, method, ratio = future.result()
+    except Exception as e:
+        for _, file_path, _, _ in items:
+            log_event("Error processing file", file_path, str(e), writer)
+        if uploader is not None:
+            uploader.release(reserved)
+        return 0
+    
+    for key, file_path, content_type, row in items:
+        # Save file record to database; the thumbnail is filled in when the ThumbnailStage has it
+        writer.execute(INSERT_FILE_SQL, row._replace(compression_method=method, sample_ratio=ratio))
+        if thumbnails is not None and wants_thumbnail(content_type):
+            thumbnails.submit(row.id, file_path, content_type)
+        
+        pbar.update(1)
+    
+    if uploader is not None:
+        # The files of a pack share its archive
+        uploader.submit(row.filepath, [row.id for _, _, _, row in items], reserved, compressed_size)
+    return compressed_size
+
+def create_tables(conn):
+    cursor = conn.cursor()
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS files (
             id TEXT PRIMARY KEY,
@@ -87,10 +708,43 @@ def compress_files_and_save_to_db(src_dir, dest_dir, conn, timestamp):
             size INTEGER,
             creation_time TEXT,
             modification_time TEXT,
-            thumbnail BLOB,
+            thumbnail BLOB, -- superseded by the thumbnails table, like the other thumbnail columns
             is_duplicate INTEGER,
             original_path TEXT,
-            batch TEXT
+            batch TEXT,
+            content_hash TEXT,
+            source_path TEXT,
+            uploaded INTEGER,
+            pack_id TEXT,
+            member_name TEXT,
+            thumbnail_format TEXT,
+            thumbnail_width INTEGER,
+            thumbnail_height INTEGER,
+            compression_method TEXT,
+            sample_ratio REAL,
+            dictionary_id TEXT,
+            creation_time_ns INTEGER,
+            modification_time_ns INTEGER,
+            original_id TEXT
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS thumbnails (
+            file_id TEXT PRIMARY KEY,
+            format TEXT,
+            width INTEGER,
+            height INTEGER,
+            data BLOB
+        )
+    ''')
+    # zstd dictionaries; each batch that trains one adds a row, and files compressed with it refer to it by id
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS dictionaries (
+            id TEXT PRIMARY KEY,
+            batch TEXT,
+            created TEXT,
+            dict_id INTEGER,
+            data BLOB
         )
     ''')
     cursor.execute('''
@@ -102,114 +756,712 @@ def compress_files_and_save_to_db(src_dir, dest_dir, conn, timestamp):
             timestamp TEXT
         )
     ''')
+    migrate_catalog(conn)
+
+def migrate_catalog(conn):
+    # Bring a catalog created by an older version up to the current schema
+    cursor = conn.cursor()
+    
+    # Columns added since the first release. Older records keep NULL, except source_path which
+    # is derived from the archive path.
+    cursor.execute('PRAGMA table_info(files)')
+    columns = {row[1] for row in cursor.fetchall()}
+    for name, definition in [('content_hash', 'TEXT'), ('source_path', 'TEXT'), ('uploaded', 'INTEGER'), ('pack_id', 'TEXT'), ('member_name', 'TEXT'),
+                               ('thumbnail_format', 'TEXT'), ('thumbnail_width', 'INTEGER'), ('thumbnail_height', 'INTEGER'),
+                               ('creation_time_ns', 'INTEGER'), ('modification_time_ns', 'INTEGER'), ('compression_method', 'TEXT'), ('sample_ratio', 'REAL'), ('dictionary_id', 'TEXT'),
+                               ('original_id', 'TEXT')]:
+        if name not in columns:
+            cursor.execute(f'ALTER TABLE files ADD COLUMN {name} {definition}')
+    if 'source_path' not in columns:
+        cursor.execute('''
+            UPDATE files SET source_path = CASE WHEN content_type = 'directory' THEN filepath ELSE substr(filepath, 1, length(filepath) - 3) END
+        ''')
+    
+    # The content hash index leads with size so that both the hash lookup and the search for
+    # unhashed records of a given size are index scans
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_files_content_hash ON files (size, content_hash)
+    ''')
+    # Newest record for a path, for incremental runs
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_files_source_path ON files (source_path, batch)
+    ''')
+    # Ordered, resumable listings in search_db.py; the id breaks ties between the members of a pack
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_files_batch_filepath ON files (batch, filepath, id)
+    ''')
+    # The original of a duplicate, for restore_dir.py: a single archive by filepath, a pack member by pack_id
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_files_filepath ON files (filepath, batch)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_files_pack_id ON files (pack_id)
+    ''')
+    # Records still waiting for regenerate_raw_thumbnails()
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_files_raw_thumbnail ON files (id) WHERE thumbnail_format = 'raw'
+    ''')
+    # Indexes on the text timestamps, superseded by those on the nanosecond columns
+    cursor.execute('DROP INDEX IF EXISTS idx_files_duplicate')
+    cursor.execute('DROP INDEX IF EXISTS idx_files_modification_time')
+    create_search_index(conn)
+    conn.commit()
     
-    # Count total files and directories for progress bar
-    total_items = sum(len(files) + len(dirs) for _, dirs, files in os.walk(src_dir))
+    # One-time data migrations, tracked in user_version
+    cursor.execute('PRAGMA user_version')
+    version = cursor.fetchone()[0]
+    if version < 1:
+        migrate_raw_thumbnails(conn)
+        move_thumbnails(conn)
+        cursor.execute('PRAGMA user_version = 1')
+    if version < 2:
+        migrate_time_columns(conn)
+        cursor.execute('PRAGMA user_version = 2')
+    if version < 3:
+        # Top-level entries used to be stored as ./name
+        cursor.execute("UPDATE files SET source_path = substr(source_path, 3) WHERE source_path LIKE './%'")
+        cursor.execute('PRAGMA user_version = 3')
     
-    with tqdm(total=total_items, desc="Processing items", unit="item") as pbar:
-        for root, dirs, files in os.walk(src_dir):
-            for dir in dirs:
+    # Indexes on the nanosecond timestamps, built once older records have them. The composite one serves the
+    # duplicate lookup, and the others time ranges in search_db.py.
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_files_duplicate_ns ON files (filename, size, creation_time_ns, modification_time_ns)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_files_modification_time_ns ON files (modification_time_ns)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_files_creation_time_ns ON files (creation_time_ns)
+    ''')
+    conn.commit()
+
+def isoformat_to_ns(text):
+    # The text timestamps are local times with microseconds, as written by datetime.fromtimestamp().isoformat()
+    if text is None:
+        return None
+    try:
+        moment = datetime.fromisoformat(text)
+    except ValueError:
+        return None
+    return int(moment.replace(microsecond=0).timestamp()) * 1000000000 + moment.microsecond * 1000
+
+def migrate_time_columns(conn):
+    # Fill in creation_time_ns and modification_time_ns for records that only have the text timestamps
+    cursor = conn.cursor()
+    last_rowid = -1
+    while True:
+        cursor.execute('''
+            SELECT rowid, creation_time, modification_time FROM files WHERE rowid > ? AND modification_time_ns IS NULL ORDER BY rowid LIMIT 1000
+        ''', (last_rowid,))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        cursor.executemany('UPDATE files SET creation_time_ns = ?, modification_time_ns = ? WHERE rowid = ?',
+                           [(isoformat_to_ns(creation_time), isoformat_to_ns(modification_time), rowid) for rowid, creation_time, modification_time in rows])
+        conn.commit()
+        last_rowid = rows[-1][0]
+
+def create_search_index(conn):
+    # Full-text index over filename and filepath for search_db.py --fts. It is an external content table,
+    # so the text is stored once in files, and triggers keep it in step with every insert, delete and rename.
+    # The rowid of files is what links the two, and VACUUM may renumber it; run
+    # INSERT INTO files_fts(files_fts) VALUES ('rebuild') after a VACUUM. Without FTS5 in this SQLite build
+    # the index is left out and only LIKE searches are available.
+    cursor = conn.cursor()
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'files_fts'")
+    if cursor.fetchone() is not None:
+        return
+    try:
+        # prefix='2 3' keeps short prefix queries such as img* off a full term scan
+        cursor.execute('''
+            CREATE VIRTUAL TABLE files_fts USING fts5 (filename, filepath, content='files', content_rowid='rowid', prefix='2 3')
+        ''')
+    except sqlite3.OperationalError:
+        return
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS files_fts_insert AFTER INSERT ON files BEGIN
+            INSERT INTO files_fts (rowid, filename, filepath) VALUES (new.rowid, new.filename, new.filepath);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS files_fts_delete AFTER DELETE ON files BEGIN
+            INSERT INTO files_fts (files_fts, rowid, filename, filepath) VALUES ('delete', old.rowid, old.filename, old.filepath);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS files_fts_update AFTER UPDATE OF filename, filepath ON files BEGIN
+            INSERT INTO files_fts (files_fts, rowid, filename, filepath) VALUES ('delete', old.rowid, old.filename, old.filepath);
+            INSERT INTO files_fts (rowid, filename, filepath) VALUES (new.rowid, new.filename, new.filepath);
+        END
+    ''')
+    # Index the records that are already in the catalog
+    cursor.execute("INSERT INTO files_fts (files_fts) VALUES ('rebuild')")
+
+def migrate_raw_thumbnails(conn):
+    # Thumbnails used to be raw pixel dumps with no mode or size, which cannot be decoded reliably.
+    # Drop them and mark their records 'raw'; regenerate_raw_thumbnails() rebuilds them from the
+    # source on the ThumbnailStage, so decoding does not hold up opening the catalog.
+    cursor = conn.cursor()
+    cursor.execute('''
+        UPDATE files SET thumbnail = NULL, thumbnail_format = 'raw' WHERE thumbnail IS NOT NULL AND thumbnail_format IS NULL
+    ''')
+    conn.commit()
+
+def regenerate_raw_thumbnails(writer, thumbnails, chunk_size=1000):
+    # Queue the records whose raw thumbnail was dropped for a new one, where the source still exists,
+    # a chunk at a time so that the queue stays short. Records left over by an interrupted run are
+    # picked up by the next one.
+    cursor = writer.conn.cursor()
+    while True:
+        writer.flush()
+        cursor.execute('''
+            SELECT id, original_path, content_type FROM files WHERE thumbnail_format = 'raw' LIMIT ?
+        ''', (chunk_size,))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        for file_id, original_path, content_type in rows:
+            if wants_thumbnail(content_type) and os.path.isfile(original_path):
+                thumbnails.submit(file_id, original_path, content_type)
+            writer.execute('UPDATE files SET thumbnail_format = NULL WHERE id = ?', (file_id,))
+        thumbnails.drain(chunk_size)
+
+def move_thumbnails(conn):
+    # Encoded thumbnails used to be stored inline in files, which dragged their BLOB pages through
+    # every scan of the table. The thumbnail columns of files stay, always NULL.
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT OR REPLACE INTO thumbnails (data, format, width, height, file_id)
+        SELECT thumbnail, thumbnail_format, thumbnail_width, thumbnail_height, id FROM files WHERE thumbnail IS NOT NULL
+    ''')
+    cursor.execute('''
+        UPDATE files SET thumbnail = NULL, thumbnail_format = NULL, thumbnail_width = NULL, thumbnail_height = NULL WHERE thumbnail IS NOT NULL
+    ''')
+    conn.commit()
+
+def latest_batch(conn):
+    cursor = conn.cursor()
+    cursor.execute('SELECT MAX(batch) FROM files')
+    return cursor.fetchone()[0]
+
+def same_modification_time(record_ns, record_text, stat):
+    # Records migrated from the text timestamps only have whole microseconds, rounded through a float;
+    # those are compared as text, as before, so an upgrade does not make every file look changed
+    if record_ns == stat.st_mtime_ns:
+        return True
+    return (record_ns is None or record_ns % 1000 == 0) and record_text == datetime.fromtimestamp(stat.st_mtime).isoformat()
+
+def is_unchanged(cursor, source_path, stat, uploading=False):
+    # Compare an entry with the newest catalog record for its path. When the run uploads, a file whose
+    # archive never made it to Azure counts as changed, so that it is archived and uploaded again.
+    cursor.execute('''
+        SELECT size, modification_time_ns, modification_time, is_duplicate, uploaded, content_type FROM files WHERE source_path = ? ORDER BY batch DESC LIMIT 1
+    ''', (source_path,))
+    record = cursor.fetchone()
+    if record is None or record[0] != stat.st_size or not same_modification_time(record[1], record[2], stat):
+        return False
+    return not (uploading and record[3] == 0 and record[4] == 0 and record[5] != 'directory')
+
+def load_duplicate_keys(conn):
+    # In-memory prefilter of (size, modification_time_ns) for every catalog record.
+    # A file whose key is not in the set cannot be a duplicate, so the lookup query is skipped.
+    # Migrated records only have whole microseconds, so a file is also looked up by
+    # isoformat_to_ns() of its text modification time, which is what the migration stored.
+    cursor = conn.cursor()
+    cursor.execute('SELECT size, modification_time_ns FROM files')
+    return set(cursor)
+
+def relative_source_path(src_dir, root, name):
+    # An entry's source_path: relative to src_dir, with forward slashes and no leading ./, so that
+    # top-level entries match a --source_prefix
+    return os.path.normpath(os.path.relpath(os.path.join(root, name), src_dir)).replace("\\", "/")
+
+def load_catalog_sizes(conn):
+    cursor = conn.cursor()
+    cursor.execute("SELECT DISTINCT size FROM files WHERE content_type IS NOT 'directory'")
+    return {row[0] for row in cursor}
+
+def hash_unchanged_source(original_path, size, modification_time_ns, modification_time):
+    # The content hash of a catalog record's source, or None when it is gone or changed since; runs on a worker thread
+    try:
+        stat = os.stat(original_path)
+        if stat.st_size != size or not same_modification_time(modification_time_ns, modification_time, stat):
+            return None
+        return hash_file(original_path)
+    except OSError:
+        return None
+
+class HashStage:
+    # Content hashes for content deduplication, computed on the worker pool ahead of the walk so that the
+    # writer thread never reads whole files itself. candidates yields the (file_path, size) of every file
+    # that will be hashed, in walk order; up to window of them are hashed ahead of the walk. Catalog records
+    # of a size that comes up are backfilled the same way: those archived without a content hash, when their
+    # source is still in place and unchanged, so new files can be matched against them. Only the writer
+    # thread calls into it.
+    def __init__(self, writer, executor, candidates, window):
+        self.writer = writer
+        self.executor = executor
+        self.candidates = candidates
+        self.window = window
+        # file_path -> future, in walk order
+        self.ahead = {}
+        # size -> [(file_id, future)] for the catalog records being backfilled, and the sizes done
+        self.backfilling = {}
+        self.backfilled = set()
+        self.fill()
+    
+    def fill(self):
+        while len(self.ahead) < self.window:
+            candidate = next(self.candidates, None)
+            if candidate is None:
+                break
+            file_path, size = candidate
+            self.ahead[file_path] = self.executor.submit(hash_file, file_path)
+            if size not in self.backfilled and size not in self.backfilling:
+                self.backfilling[size] = self.start_backfill(size)
+    
+    def start_backfill(self, size):
+        cursor = self.writer.conn.cursor()
+        cursor.execute('''
+            SELECT id, original_path, modification_time_ns, modification_time FROM files
+            WHERE size = ? AND content_hash IS NULL AND is_duplicate = 0 AND content_type IS NOT 'directory'
+        ''', (size,))
+        return [(file_id, self.executor.submit(hash_unchanged_source, original_path, size, modification_time_ns, modification_time))
+                for file_id, original_path, modification_time_ns, modification_time in cursor.fetchall()]
+    
+    def hash(self, file_path):
+        # The content hash of the file the walk is at. Files queued before it that the walk gave up on are
+        # dropped; a file candidates did not yield is hashed on its own.
+        if file_path not in self.ahead:
+            return self.executor.submit(hash_file, file_path).result()
+        while True:
+            ahead_path, future = next(iter(self.ahead.items()))
+            del self.ahead[ahead_path]
+            if ahead_path == file_path:
+                self.fill()
+                return future.result()
+    
+    def backfill(self, size):
+        # Save the backfilled hashes of this size, once, before the first lookup of a file of that size
+        if size in self.backfilled:
+            return
+        for file_id, future in self.backfilling.pop(size, None) or self.start_backfill(size):
+            content_hash = future.result()
+            if content_hash is not None:
+                self.writer.execute('UPDATE files SET content_hash = ? WHERE id = ?', (content_hash, file_id))
+        self.backfilled.add(size)
+
+def find_content_duplicate(writer, content_hash, size, hashes):
+    writer.flush()
+    hashes.backfill(size)
+    writer.flush()
+    cursor = writer.conn.cursor()
+    cursor.execute('''
+        SELECT id, filepath, pack_id, member_name, dictionary_id FROM files WHERE size = ? AND content_hash = ? AND is_duplicate = 0 LIMIT 1
+    ''', (size, content_hash))
+    return cursor.fetchone()
+
+def compress_files_and_save_to_db(src_dir, dest_dir, writer, timestamp, workers=1, scan=None, dedup='metadata', incremental=False, compressor='7z', pack_threshold=0, pack_size=256 * 1024 * 1024,
+                                  uploader=None, thumbnail_workers=2, thumbnail_timeout=60, policy=None, zstd_dict_size=ZSTD_DICT_SIZE, uploading=False):
+    # Returns the total size of the archives written to dest_dir.
+    # scan is the result of scan_directory(src_dir), if the caller already has it.
+    # dedup is 'metadata' (filename, size and times) or 'content' (size and content hash).
+    # With incremental, entries whose size and modification time match their newest catalog record are skipped.
+    # compressor is a key of COMPRESSORS.
+    # Files smaller than pack_threshold bytes are grouped into solid pack archives of about pack_size bytes
+    # under PACK_DIRECTORY; their records carry the pack_id and member_name. A pack_threshold of 0 disables packing.
+    # uploader is an optional UploadPipeline that uploads and deletes each archive as soon as it is written.
+    # Thumbnails are generated by thumbnail_workers processes, each item given thumbnail_timeout seconds; 0 workers disables them.
+    # policy, from load_policy, picks the compression method of each file that is not packed; the built-in policy by default.
+    # With the zstd compressor, a dictionary of zstd_dict_size bytes is trained for the batch and used for small
+    # text-like files; its id goes in their dictionary_id. 0 disables it.
+    # uploading tells incremental runs that the archives go to Azure, so files whose upload failed are not skipped.
+    conn = writer.conn
+    cursor = conn.cursor()
+    
+    # Create tables
+    create_tables(conn)
+    
+    # Walk the source tree once for both the progress bar and the compression stage
+    if scan is None:
+        scan = scan_directory(src_dir)
+    entries, total_items, _ = scan
+    if policy is None:
+        policy = load_policy()
+    extension = COMPRESSORS[compressor][0]
+    pack_extension = COMPRESSORS[compressor][2]
+    
+    if dedup == 'content':
+        # Only a file whose size is shared with another file here or in the catalog can have a copy, so only those are hashed
+        scan_sizes = Counter(stat.st_size for _, _, files in entries for _, stat in files if not isinstance(stat, OSError))
+        catalog_sizes = load_catalog_sizes(conn)
+        
+        def hash_candidates():
+            # The files the walk below hashes, in its order: those it does not skip, with a shared size
+            lookup = conn.cursor()
+            for root, _, files in entries:
+                for file, stat in files:
+                    if isinstance(stat, OSError) or not (scan_sizes[stat.st_size] > 1 or stat.st_size in catalog_sizes):
+                        continue
+                    if incremental and is_unchanged(lookup, relative_source_path(src_dir, root, file), stat, uploading):
+                        continue
+                    yield os.path.join(root, file), stat.st_size
+    else:
+        known_keys = load_duplicate_keys(conn)
+    compressed_size = 0
+    
+    dictionary = None
+    if compressor == 'zstd' and zstd_dict_size > 0:
+        dictionary, samples = train_dictionary(entries, pack_threshold, zstd_dict_size)
+        if dictionary is not None:
+            dictionary_id = str(uuid.uuid4())
+            writer.execute(INSERT_DICTIONARY_SQL, (dictionary_id, timestamp, datetime.now().isoformat(), dictionary.dict_id(), dictionary.as_bytes()))
+            tqdm.write(f"Trained a {format_size(len(dictionary.as_bytes()))} zstd dictionary on {samples} files")
+    
+    # Compressions handed to the worker pool, in walk order, whose records are not written yet.
+    # The calling thread is the only one that touches the database and the progress bar.
+    pending = deque()
+    pending_keys = Counter()
+    thumbnails = ThumbnailStage(writer, thumbnail_workers, thumbnail_timeout) if thumbnail_workers > 0 else None
+    
+    # The open pack: its id, queued (key, file_path, content_type, row) items and their total size.
+    # Its files count in pending_keys already.
+    pack_id = str(uuid.uuid4())
+    pack_items = []
+    pack_bytes = 0
+    pack_path = os.path.join(dest_dir, PACK_DIRECTORY)
+    
+    def make_room(size):
+        # Backpressure: hold the compression stage until the archives in dest_dir, and those being
+        # written, fit under the uploader's scratch limit. Source sizes stand in for unwritten archives.
+        nonlocal compressed_size
+        if uploader is None:
+            return
+        uploader.poll()
+        while uploader.is_full(size):
+            if uploader.in_flight:
+                uploader.wait()
+            elif pending:
+                compressed_size += write_compressed_file(pending.popleft(), pending_keys, writer, pbar, uploader, thumbnails)
+            elif not uploader.retry_failed():
+                break
+        uploader.reserve(size)
+    
+    def submit_pack():
+        make_room(pack_bytes)
+        members = [(file_path, row.member_name) for _, file_path, _, row in pack_items]
+        archive_path = os.path.join(pack_path, pack_id + pack_extension)
+        os.makedirs(pack_path, exist_ok=True)
+        return (executor.submit(pack_files, members, archive_path, compressor, src_dir), pack_items)
+    
+    with tqdm(total=total_items, desc="Processing items", unit="item") as pbar, ThreadPoolExecutor(max_workers=workers) as executor:
+        if dedup == 'content':
+            hashes = HashStage(writer, executor, hash_candidates(), workers * 2)
+        for root, dirs, files in entries:
+            if thumbnails is not None:
+                thumbnails.poll()
+            relative_path = os.path.relpath(root, src_dir)
+            dest_path = os.path.join(dest_dir, relative_path)
+            
+            if (dirs or files) and not os.path.exists(dest_path):
+                os.makedirs(dest_path)
+            
+            for dir, stat in dirs:
                 dir_path = os.path.join(root, dir)
-                relative_path = os.path.relpath(root, src_dir)
-                dest_path = os.path.join(dest_dir, relative_path)
-                
-                if not os.path.exists(dest_path):
-                    os.makedirs(dest_path)
+                if isinstance(stat, OSError):
+                    log_event("Error processing directory", dir_path, str(stat), writer)
+                    continue
                 
                 # Save directory record to database
                 original_filename = dir
-                stat = os.stat(dir_path)
+                source_path = relative_source_path(src_dir, root, dir)
                 size = stat.st_size
                 creation_time = datetime.fromtimestamp(stat.st_ctime).isoformat()
                 modification_time = datetime.fromtimestamp(stat.st_mtime).isoformat()
                 
-                cursor.execute('''
-                    INSERT INTO files (id, filename, filepath, content_type, size, creation_time, modification_time, thumbnail, is_duplicate, original_path, batch)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (str(uuid.uuid4()), original_filename, os.path.join(relative_path, dir).replace("\\", "/"), "directory", size, creation_time, modification_time, None, 0, dir_path, timestamp))
+                if incremental and is_unchanged(cursor, source_path, stat, uploading):
+                    pbar.update(1)
+                    continue
+                
+                writer.execute(INSERT_FILE_SQL, FileRow(id=str(uuid.uuid4()), filename=original_filename, filepath=source_path, content_type="directory", size=size,
+                                                        creation_time=creation_time, modification_time=modification_time, original_path=dir_path, batch=timestamp,
+                                                        source_path=source_path, creation_time_ns=stat.st_ctime_ns, modification_time_ns=stat.st_mtime_ns))
+                if dedup != 'content':
+                    known_keys.add((size, stat.st_mtime_ns))
                 
                 pbar.update(1)
             
-            for file in files:
+            for file, stat in files:
                 file_path = os.path.join(root, file)
-                relative_path = os.path.relpath(root, src_dir)
-                dest_path = os.path.join(dest_dir, relative_path)
-                
-                if not os.path.exists(dest_path):
-                    os.makedirs(dest_path)
                 
                 try:
                     # Check for duplicates in the database
                     original_filename = file
                     content_type, _ = mimetypes.guess_type(file_path)
-                    stat = os.stat(file_path)
+                    if isinstance(stat, OSError):
+                        raise stat
                     size = stat.st_size
                     creation_time = datetime.fromtimestamp(stat.st_ctime).isoformat()
                     modification_time = datetime.fromtimestamp(stat.st_mtime).isoformat()
+                    source_path = relative_source_path(src_dir, root, file)
+                    
+                    # Unchanged since the last run, or already saved by the interrupted run being resumed
+                    if incremental and is_unchanged(cursor, source_path, stat, uploading):
+                        pbar.update(1)
+                        continue
+                    
+                    if dedup == 'content':
+                        content_hash = hashes.hash(file_path) if scan_sizes[size] > 1 or size in catalog_sizes else None
+                        key = content_hash
+                    else:
+                        content_hash = None
+                        key = (original_filename, size, stat.st_ctime_ns, stat.st_mtime_ns)
+                    
+                    # A matching file still in the worker pool, or in the open pack, must be saved first, exactly as a serial run would
+                    while key is not None and pending_keys[key]:
+                        if not pending:
+                            pending.append(submit_pack())
+                            pack_id, pack_items, pack_bytes = str(uuid.uuid4()), [], 0
+                        compressed_size += write_compressed_file(pending.popleft(), pending_keys, writer, pbar, uploader, thumbnails)
                     
-                    cursor.execute('''
-                        SELECT filepath FROM files WHERE filename = ? AND size = ? AND creation_time = ? AND modification_time = ?
-                    ''', (original_filename, size, creation_time, modification_time))
-                    original_record = cursor.fetchone()
+                    if dedup == 'content':
+                        original_record = find_content_duplicate(writer, content_hash, size, hashes) if content_hash else None
+                    elif (size, stat.st_mtime_ns) in known_keys or (size, isoformat_to_ns(modification_time)) in known_keys:
+                        # Records migrated from the text timestamps are matched on those, as in same_modification_time()
+                        writer.flush()
+                        cursor.execute('''
+                            SELECT id, filepath, pack_id, member_name, dictionary_id FROM files WHERE filename = ? AND size = ?
+                            AND ((creation_time_ns = ? AND modification_time_ns = ?)
+                                 OR ((modification_time_ns IS NULL OR modification_time_ns % 1000 = 0) AND creation_time = ? AND modification_time = ?))
+                            LIMIT 1
+                        ''', key + (creation_time, modification_time))
+                        original_record = cursor.fetchone()
+                    else:
+                        original_record = None
+                    if dedup != 'content':
+                        known_keys.add((size, stat.st_mtime_ns))
                     is_duplicate = original_record is not None
                     
                     if is_duplicate:
-                        original_path = original_record[0]
-                        cursor.execute('''
-                            INSERT INTO files (id, filename, filepath, content_type, size, creation_time, modification_time, thumbnail, is_duplicate, original_path, batch)
-                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                        ''', (str(uuid.uuid4()), original_filename, os.path.join(relative_path, file + '.7z').replace("\\", "/"), content_type, size, creation_time, modification_time, None, 1, original_path, timestamp))
+                        # A duplicate keeps the id of the record it matched, which restore_dir.py follows to the archive. It also
+                        # points at the same pack member as a duplicate of a packed file, and at the dictionary of one compressed with a dictionary.
+                        original_id, original_path, original_pack_id, original_member_name, original_dictionary_id = original_record
+                        writer.execute(INSERT_FILE_SQL, FileRow(id=str(uuid.uuid4()), filename=original_filename, filepath=os.path.join(relative_path, file + extension).replace("\\", "/"),
+                                                                content_type=content_type, size=size, creation_time=creation_time, modification_time=modification_time,
+                                                                original_path=original_path, batch=timestamp, source_path=source_path,
+                                                                creation_time_ns=stat.st_ctime_ns, modification_time_ns=stat.st_mtime_ns, is_duplicate=1, content_hash=content_hash,
+                                                                pack_id=original_pack_id, member_name=original_member_name, dictionary_id=original_dictionary_id,
+                                                                original_id=original_id))
                         pbar.update(1)
                         continue
                     
-                    # Compress the file with fastest compression
-                    zip_file_path = os.path.join(dest_path, file + '.7z')
-                    compression_level = os.getenv('COMPRESSION_LEVEL', '5')
-                    subprocess.run(['7z', 'a', '-t7z', f'-mx={compression_level}', '-m0=LZMA2', '-md=32m', '-ms=64m', '-mmt=4', '-bd', zip_file_path, file_path], 
-                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
-                    
-                    # Generate thumbnail
-                    thumbnail = generate_thumbnail(file_path, content_type, conn) if content_type and (content_type.startswith('image/') or content_type.startswith('video/')) else None
+                    pending_keys[key] += 1
+                    if size < pack_threshold:
+                        # Queue the file in the open pack, and hand the pack to the worker pool once it is full
+                        member_name = os.path.relpath(file_path, src_dir).replace("\\", "/")
+                        row = FileRow(id=str(uuid.uuid4()), filename=original_filename, filepath=PACK_DIRECTORY + '/' + pack_id + pack_extension, content_type=content_type,
+                                      size=size, creation_time=creation_time, modification_time=modification_time, original_path=file_path, batch=timestamp,
+                                      source_path=source_path, creation_time_ns=stat.st_ctime_ns, modification_time_ns=stat.st_mtime_ns, content_hash=content_hash,
+                                      pack_id=pack_id, member_name=member_name)
+                        pack_items.append((key, file_path, content_type, row))
+                        pack_bytes += size
+                        if pack_bytes >= pack_size:
+                            pending.append(submit_pack())
+                            pack_id, pack_items, pack_bytes = str(uuid.uuid4()), [], 0
+                    else:
+                        # Compress the file on the worker pool, which also picks its method; the record is saved once it finishes
+                        make_room(size)
+                        archive_path = os.path.join(dest_path, file + extension)
+                        use_dictionary = dictionary is not None and size <= ZSTD_DICT_FILE_LIMIT and is_text_like(content_type)
+                        future = executor.submit(compress_file, file_path, archive_path, compressor, policy, content_type, dictionary if use_dictionary else None)
+                        row = FileRow(id=str(uuid.uuid4()), filename=original_filename, filepath=os.path.join(relative_path, file + extension).replace("\\", "/"), content_type=content_type,
+                                      size=size, creation_time=creation_time, modification_time=modification_time, original_path=file_path, batch=timestamp,
+                                      source_path=source_path, creation_time_ns=stat.st_ctime_ns, modification_time_ns=stat.st_mtime_ns, content_hash=content_hash,
+                                      dictionary_id=dictionary_id if use_dictionary else None)
+                        pending.append((future, [(key, file_path, content_type, row)]))
                     
-                    # Save file record to database
-                    cursor.execute('''
-                        INSERT INTO files (id, filename, filepath, content_type, size, creation_time, modification_time, thumbnail, is_duplicate, original_path, batch)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    ''', (str(uuid.uuid4()), original_filename, os.path.join(relative_path, file + '.7z').replace("\\", "/"), content_type, size, creation_time, modification_time, thumbnail, 0, file_path, timestamp))
-                    
-                    pbar.update(1)
+                    # Keep a bounded window of files in flight
+                    while len(pending) > workers * 2:
+                        compressed_size += write_compressed_file(pending.popleft(), pending_keys, writer, pbar, uploader, thumbnails)
                 except Exception as e:
-                    log_event("Error processing file", file_path, str(e), conn)
+                    log_event("Error processing file", file_path, str(e), writer)
+        
+        if pack_items:
+            pending.append(submit_pack())
+        while pending:
+            compressed_size += write_compressed_file(pending.popleft(), pending_keys, writer, pbar, uploader, thumbnails)
     
-    conn.commit()
+    if thumbnails is not None:
+        # Thumbnails dropped by the raw thumbnail migration are rebuilt once the archive is written
+        regenerate_raw_thumbnails(writer, thumbnails)
+        thumbnails.close()
+    writer.commit()
+    return compressed_size
+
+def open_container(container_name, connection_string, max_block_size=MAX_BLOCK_SIZE, max_single_put_size=MAX_SINGLE_PUT_SIZE):
+    # Blobs larger than max_single_put_size are sent as blocks of max_block_size, which can go in parallel
+    blob_service_client = BlobServiceClient.from_connection_string(connection_string, max_block_size=max_block_size,
+                                                                    max_single_put_size=max_single_put_size)
+    return blob_service_client.get_container_client(container_name)
+
+def upload_archive(container_client, local_file, blob_file, max_concurrency, delay=0):
+    # Upload one archive and return its size; runs on an upload thread, after delay seconds for a retry
+    if delay:
+        time.sleep(delay)
+    with open(local_file, "rb") as data:
+        container_client.get_blob_client(blob_file).upload_blob(data, overwrite=True, max_concurrency=max_concurrency)
+    return os.path.getsize(local_file)
+
+def show_throughput(pbar, uploaded_bytes, start):
+    elapsed = time.monotonic() - start
+    if elapsed > 0:
+        pbar.set_postfix(uploaded=format_size(uploaded_bytes), rate=f"{format_size(uploaded_bytes / elapsed)}/s")
 
-def upload_to_azure(container_name, connection_string, dest_dir, timestamp, conn):
-    blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-    container_client = blob_service_client.get_container_client(container_name)
+class UploadPipeline:
+    # Uploads archives while the compression stage is still running, and deletes each local archive
+    # once its upload is confirmed. dest_dir holds at most about scratch_limit bytes: the compression
+    # stage reserves room before it writes an archive and waits for uploads when there is none.
+    # A failed upload is retried with backoff; an archive that still fails stays in dest_dir, and
+    # counted against scratch_limit, until retry_failed() or the upload_to_azure pass sends it.
+    # Only the writer thread calls into it.
+    def __init__(self, container_client, dest_dir, timestamp, writer, upload_workers=8, max_concurrency=4, scratch_limit=SCRATCH_LIMIT):
+        self.container_client = container_client
+        self.dest_dir = dest_dir
+        self.timestamp = timestamp
+        self.writer = writer
+        self.max_concurrency = max_concurrency
+        self.scratch_limit = scratch_limit
+        self.scratch_bytes = 0
+        self.uploaded_bytes = 0
+        self.start = time.monotonic()
+        self.executor = ThreadPoolExecutor(max_workers=upload_workers)
+        # future -> (file_path, file_ids, archive size, attempt)
+        self.in_flight = {}
+        # Archives whose retries ran out: [(file_path, file_ids, archive size)]
+        self.failed = []
+        self.pbar = tqdm(total=0, desc="Uploading to Azure", unit="file", position=1)
     
-    cursor = conn.cursor()
+    def is_full(self, size):
+        return self.scratch_bytes > 0 and self.scratch_bytes + size > self.scratch_limit
+    
+    def reserve(self, size):
+        self.scratch_bytes += size
+    
+    def release(self, size):
+        self.scratch_bytes -= size
+    
+    def submit(self, file_path, file_ids, reserved, compressed_size):
+        # The archive is written; swap its reservation for its real size and start the upload
+        self.scratch_bytes += compressed_size - reserved
+        self.upload(file_path, file_ids, compressed_size)
+        self.pbar.total += 1
+        self.pbar.refresh()
+    
+    def upload(self, file_path, file_ids, size, attempt=0):
+        local_file = (self.dest_dir + '/' + file_path).replace("\\", "/")
+        blob_file = (self.timestamp + '/' + file_path).replace("\\", "/")
+        delay = UPLOAD_BACKOFF * 2 ** (attempt - 1) if attempt else 0
+        future = self.executor.submit(upload_archive, self.container_client, local_file, blob_file, self.max_concurrency, delay)
+        self.in_flight[future] = (file_path, file_ids, size, attempt)
+    
+    def finish(self, done):
+        for future in done:
+            file_path, file_ids, size, attempt = self.in_flight.pop(future)
+            try:
+                self.uploaded_bytes += future.result()
+            except Exception as e:
+                log_event("Error uploading file to Azure", file_path, str(e), self.writer)
+                if attempt < UPLOAD_RETRIES:
+                    self.upload(file_path, file_ids, size, attempt + 1)
+                else:
+                    # The archive stays in dest_dir, and keeps its room, for a later retry
+                    self.failed.append((file_path, file_ids, size))
+                continue
+            for file_id in file_ids:
+                self.writer.execute('UPDATE files SET uploaded = 1 WHERE id = ?', (file_id,))
+            os.remove((self.dest_dir + '/' + file_path).replace("\\", "/"))
+            self.release(size)
+            self.pbar.update(1)
+            show_throughput(self.pbar, self.uploaded_bytes, self.start)
+    
+    def retry_failed(self):
+        # Send the archives whose retries ran out through another round of them; False if there are none
+        if not self.failed:
+            return False
+        tqdm.write(f"Scratch limit reached with {len(self.failed)} archives that failed to upload; retrying them")
+        for file_path, file_ids, size in self.failed:
+            self.upload(file_path, file_ids, size, 1)
+        self.failed = []
+        return True
     
-    # Count total files for progress bar
-    cursor.execute('SELECT COUNT(*) FROM files WHERE batch = ? AND is_duplicate = 0', (timestamp,))
-    total_files = cursor.fetchone()[0]
+    def poll(self):
+        self.finish([future for future in self.in_flight if future.done()])
     
-    with tqdm(total=total_files, desc="Uploading to Azure", unit="file") as pbar:
-        cursor.execute('SELECT filepath FROM files WHERE batch = ? AND is_duplicate = 0 AND content_type != "directory"', (timestamp,))
-        for row in cursor.fetchall():
-            file_path = row[0]
-            # blob_path = os.path.join(timestamp, os.path.relpath(file_path, dest_dir)).replace("\\", "/")
+    def wait(self):
+        self.finish(wait(self.in_flight, return_when=FIRST_COMPLETED).done)
+    
+    def close(self):
+        # Archives that still fail are left to the upload_to_azure pass, which needs the uploaded flags flushed
+        while self.in_flight:
+            self.finish(wait(self.in_flight).done)
+        self.executor.shutdown()
+        self.pbar.close()
+        self.writer.flush()
+
+def pending_uploads(cursor, timestamp):
+    # The archives of a batch that are not uploaded yet: filepath -> [file ids]
+    cursor.execute("SELECT id, filepath FROM files WHERE batch = ? AND is_duplicate = 0 AND content_type IS NOT 'directory' AND uploaded = 0", (timestamp,))
+    archives = {}
+    for file_id, file_path in cursor.fetchall():
+        archives.setdefault(file_path, []).append(file_id)
+    return archives
 
+def upload_to_azure(container_name, connection_string, dest_dir, timestamp, writer, upload_workers=8, max_concurrency=4,
+                    max_block_size=MAX_BLOCK_SIZE, max_single_put_size=MAX_SINGLE_PUT_SIZE, container_client=None):
+    # Up to upload_workers blobs are in flight at once, and each large blob sends up to max_concurrency
+    # blocks in parallel. container_client may be passed in, e.g. for the Azurite emulator or a test fake.
+    # Returns the number of archives that failed to upload.
+    if container_client is None:
+        container_client = open_container(container_name, connection_string, max_block_size, max_single_put_size)
+    
+    # Buffered uploaded flags, e.g. from an UploadPipeline, must be visible to the query below
+    writer.flush()
+    cursor = writer.conn.cursor()
+    
+    # Files uploaded before an interrupted run was resumed are skipped. Files in the same pack share
+    # one archive, which is uploaded once.
+    archives = pending_uploads(cursor, timestamp)
+    
+    uploaded_bytes = 0
+    start = time.monotonic()
+    # Uploads in flight: future -> (file_path, file_ids). Only this thread touches the catalog and the progress bar.
+    in_flight = {}
+    
+    def finish(done):
+        nonlocal uploaded_bytes
+        for future in done:
+            file_path, file_ids = in_flight.pop(future)
+            try:
+                uploaded_bytes += future.result()
+                for file_id in file_ids:
+                    writer.execute('UPDATE files SET uploaded = 1 WHERE id = ?', (file_id,))
+                pbar.update(1)
+                show_throughput(pbar, uploaded_bytes, start)
+            except Exception as e:
+                log_event("Error uploading file to Azure", file_path, str(e), writer)
+    
+    with tqdm(total=len(archives), desc="Uploading to Azure", unit="file") as pbar, ThreadPoolExecutor(max_workers=upload_workers) as executor:
+        for file_path, file_ids in archives.items():
             local_file = (dest_dir + '/' + file_path).replace("\\", "/")
             blob_file = (timestamp + '/' + file_path).replace("\\", "/")
-            blob_client = container_client.get_blob_client(blob_file)
+            in_flight[executor.submit(upload_archive, container_client, local_file, blob_file, max_concurrency)] = (file_path, file_ids)
             
-            try:
-                print(f"Uploading: {local_file} -> {blob_file}")
-                with open(local_file, "rb") as data:
-                    blob_client.upload_blob(data, overwrite=True)
-                    pbar.update(1)
-            except Exception as e:
-                log_event("Error uploading file to Azure", file_path, str(e), conn)
+            if len(in_flight) >= upload_workers * 2:
+                finish(wait(in_flight, return_when=FIRST_COMPLETED).done)
+        finish(wait(in_flight).done)
+    
+    writer.flush()
+    return len(pending_uploads(cursor, timestamp))
 
 def remove_directory(directory):
     for root, dirs, files in os.walk(directory, topdown=False):
@@ -219,10 +1471,6 @@ def remove_directory(directory):
             os.rmdir(os.path.join(root, dir))
     os.rmdir(directory)
 
-def custom_warning_handler(message, category, filename, lineno, file=None, line=None):
-    if "ffmpeg_reader.py" in filename:
-        log_event("FFmpeg Warning", filename, str(message), conn)
-
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Compress files in a directory individually and save metadata to a database.")
     parser.add_argument("--src_directory", help="Source directory to compress files from", 
@@ -235,28 +1483,78 @@ if __name__ == "__main__":
                         default=os.getenv('AZURE_CONTAINER'))
     parser.add_argument("--azure_connection_string", help="Azure Blob Storage connection string", 
                         default=os.getenv('AZURE_CONNECTION_STRING'))
+    parser.add_argument("--workers", type=int, help="Number of files to compress concurrently",
+                        default=int(os.getenv('WORKERS', os.cpu_count() or 1)))
+    parser.add_argument("--dedup", choices=['metadata', 'content'], help="Match duplicates by filename, size and times, or by content hash",
+                        default=os.getenv('DEDUP_MODE', 'metadata'))
+    parser.add_argument("--commit_rows", type=int, help="Commit catalog writes after this many rows",
+                        default=int(os.getenv('COMMIT_ROWS', '1000')))
+    parser.add_argument("--commit_interval", type=float, help="Commit catalog writes after this many seconds",
+                        default=float(os.getenv('COMMIT_INTERVAL', '5')))
+    parser.add_argument("--compressor", choices=sorted(COMPRESSORS), help="Compressor backend: the external 7z, or in-process xz, py7zr or zstd",
+                        default=os.getenv('COMPRESSOR', '7z'))
+    parser.add_argument("--zstd_dict_size", type=int, help="With --compressor zstd, size in bytes of the dictionary trained for small text files (0 disables it)",
+                        default=int(os.getenv('ZSTD_DICT_SIZE', str(ZSTD_DICT_SIZE))))
+    parser.add_argument("--pack_threshold", type=int, help="Pack files smaller than this many bytes into shared solid archives (0 disables packing)",
+                        default=int(os.getenv('PACK_THRESHOLD', '0')))
+    parser.add_argument("--pack_size", type=int, help="Target size in bytes of a pack archive",
+                        default=int(os.getenv('PACK_SIZE', str(256 * 1024 * 1024))))
+    parser.add_argument("--upload_workers", type=int, help="Number of blobs uploaded concurrently",
+                        default=int(os.getenv('UPLOAD_WORKERS', '8')))
+    parser.add_argument("--max_concurrency", type=int, help="Parallel block uploads within one large blob",
+                        default=int(os.getenv('MAX_CONCURRENCY', '4')))
+    parser.add_argument("--max_block_size", type=int, help="Block size in bytes for chunked blob uploads",
+                        default=int(os.getenv('MAX_BLOCK_SIZE', str(MAX_BLOCK_SIZE))))
+    parser.add_argument("--max_single_put_size", type=int, help="Largest blob in bytes uploaded in a single request",
+                        default=int(os.getenv('MAX_SINGLE_PUT_SIZE', str(MAX_SINGLE_PUT_SIZE))))
+    parser.add_argument("--pipeline", action="store_true", help="Upload and delete each archive as soon as it is written, instead of after compression")
+    parser.add_argument("--scratch_limit", type=int, help="With --pipeline, the most bytes of archives kept in the destination directory",
+                        default=int(os.getenv('SCRATCH_LIMIT', str(SCRATCH_LIMIT))))
+    parser.add_argument("--thumbnail_workers", type=int, help="Number of thumbnail processes (0 disables thumbnails)",
+                        default=int(os.getenv('THUMBNAIL_WORKERS', '2')))
+    parser.add_argument("--thumbnail_timeout", type=float, help="Seconds a single thumbnail may take before it is given up on",
+                        default=float(os.getenv('THUMBNAIL_TIMEOUT', '60')))
+    parser.add_argument("--policy_file", help="JSON compression policy mapping content types and extensions to store, fast, default or max",
+                        default=os.getenv('POLICY_FILE'))
+    parser.add_argument("--incremental", action="store_true", help="Only archive files that are new or changed since their newest catalog record")
+    parser.add_argument("--resume", action="store_true", help="Continue the most recent batch after an interrupted run (implies --incremental)")
     
     args = parser.parse_args()
+    policy = load_policy(args.policy_file)
     
     start_time = datetime.now()
     print(f"Process started at: {start_time}")
     
-    original_size = get_directory_size(args.src_directory)
+    # Walk the source tree once; the scan is reused by the compression stage
+    scan = scan_directory(args.src_directory)
+    original_size = scan[2]
     
     # Generate a timestamp
     timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
     
     # Open a single database connection
-    conn = sqlite3.connect(args.db_path)
+    conn = open_catalog(args.db_path)
+    writer = CatalogWriter(conn, args.commit_rows, args.commit_interval)
     
-    # Set custom warning handler
-    warnings.showwarning = custom_warning_handler
+    # Resume the most recent batch; whatever it already committed is skipped
+    if args.resume:
+        timestamp = latest_batch(conn) or timestamp
+    
+    # Upload each archive while compression is still running, if asked to
+    uploader = None
+    if args.pipeline and args.azure_container and args.azure_connection_string:
+        container_client = open_container(args.azure_container, args.azure_connection_string, args.max_block_size, args.max_single_put_size)
+        uploader = UploadPipeline(container_client, args.dest_directory, timestamp, writer, args.upload_workers, args.max_concurrency, args.scratch_limit)
     
     try:
         # Compress files and save metadata to the database
-        compress_files_and_save_to_db(args.src_directory, args.dest_directory, conn, timestamp)
-        
-        compressed_size = get_directory_size(args.dest_directory)
+        compressed_size = compress_files_and_save_to_db(args.src_directory, args.dest_directory, writer, timestamp, workers=args.workers, scan=scan, dedup=args.dedup,
+                                                        incremental=args.incremental or args.resume, compressor=args.compressor,
+                                                        pack_threshold=args.pack_threshold, pack_size=args.pack_size, uploader=uploader,
+                                                        thumbnail_workers=args.thumbnail_workers, thumbnail_timeout=args.thumbnail_timeout, policy=policy,
+                                                        zstd_dict_size=args.zstd_dict_size, uploading=bool(args.azure_container and args.azure_connection_string))
+        if uploader is not None:
+            uploader.close()
         
         end_time = datetime.now()
         print(f"Process ended at: {end_time}")
@@ -266,14 +1564,18 @@ if __name__ == "__main__":
         
         print(f"Directory tree saved to database: {args.db_path}")
         
-        # Upload to Azure Blob Storage if specified
+        # Upload to Azure Blob Storage if specified; after a pipelined run this only retries failed uploads
         if args.azure_container and args.azure_connection_string:
-            upload_to_azure(args.azure_container, args.azure_connection_string, args.dest_directory, timestamp, conn)
+            failed = upload_to_azure(args.azure_container, args.azure_connection_string, args.dest_directory, timestamp, writer,
+                                     args.upload_workers, args.max_concurrency, args.max_block_size, args.max_single_put_size)
             print(f"Files uploaded to Azure Blob Storage container: {args.azure_container}")
             
-            # Remove the created destination files and directory
-            remove_directory(args.dest_directory)
-            print(f"Removed destination directory: {args.dest_directory}")
+            # Remove the created destination files and directory, unless archives in it still have to be uploaded
+            if failed:
+                print(f"{failed} archives failed to upload and were kept in {args.dest_directory}; run again with --resume to retry them")
+            else:
+                remove_directory(args.dest_directory)
+                print(f"Removed destination directory: {args.dest_directory}")
     finally:
-        conn.close()
-        warnings.showwarning = warnings._showwarnmsg_impl  # Reset warning handler to default
\ No newline at end of file
+        writer.commit()
+        conn.close()
\ No newline at end of file
@@ -0,0 +1,437 @@
+import os
+import argparse
+import io
+import sqlite3
+import lzma
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+from tqdm import tqdm
+from azure.storage.blob import BlobServiceClient
+from dotenv import load_dotenv
+from search_db import compile_filters, parse_size, parse_time
+
+# Optional in-process 7z reader, used when the 7z command is not installed
+try:
+    import py7zr
+except ImportError:
+    py7zr = None
+
+# Optional Zstandard (pip install zstandard), for archives written by the zstd compressor backend
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Load environment variables from .env file
+load_dotenv()
+
+COPY_CHUNK_SIZE = 1024 * 1024
+# Buffer, and so range request, size for reading a .7z straight from its blob
+STREAM_CHUNK_SIZE = 4 * 1024 * 1024
+
+# The files columns a restore reads from a record
+RECORD_COLUMNS = '''id, filename, content_type, size, filepath, original_path, is_duplicate, batch, source_path, pack_id, member_name,
+                    modification_time_ns, dictionary_id, content_hash, original_id'''
+
+def select_records(conn, filter_criteria):
+    # The newest matching record for each source path, so that a restore across incremental batches
+    # gets the latest version of every file. filter_criteria is compiled by search_db.compile_filters.
+    conditions, values = compile_filters(filter_criteria)
+    query = f'''
+        SELECT {RECORD_COLUMNS}
+        FROM files
+    '''
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY files.batch"
+    records = {}
+    for record in conn.execute(query, values):
+        records[record['source_path']] = record
+    return list(records.values())
+
+def locate_archive(cursor, record):
+    # Returns the (batch, filepath, member_name) of the archive holding a record's content. A duplicate was
+    # matched against an earlier record, possibly from an earlier batch, whose id it keeps in original_id;
+    # that record may be a duplicate in turn. Duplicates written before original_id are found again: a pack
+    # member through its pack_id, and a single archive through original_path, the filepath of the record it
+    # matched, and its content hash where it has one. cursor must return sqlite3.Row records.
+    if not record['is_duplicate']:
+        return record['batch'], record['filepath'], record['member_name']
+    if record['original_id'] is not None:
+        cursor.execute(f'SELECT {RECORD_COLUMNS} FROM files WHERE id = ?', (record['original_id'],))
+        original = cursor.fetchone()
+        if original is None:
+            raise LookupError(f"The original record {record['original_id']} is not in the catalog")
+        return locate_archive(cursor, original)
+    if record['pack_id'] is not None:
+        cursor.execute('''
+            SELECT batch, filepath FROM files WHERE pack_id = ? AND is_duplicate = 0 LIMIT 1
+        ''', (record['pack_id'],))
+    else:
+        cursor.execute('''
+            SELECT batch, filepath FROM files WHERE filepath = ? AND size = ? AND is_duplicate = 0 AND batch <= ? AND (? IS NULL OR content_hash = ?)
+            ORDER BY batch DESC LIMIT 1
+        ''', (record['original_path'], record['size'], record['batch'], record['content_hash'], record['content_hash']))
+    original = cursor.fetchone()
+    if original is None:
+        raise LookupError(f"No archive found for the original {record['original_path']}")
+    return original[0], original[1], record['member_name']
+
+def restore_path(restore_dir, source_path):
+    # Where a record goes under restore_dir; a source path that would land outside it is refused
+    path = os.path.normpath(os.path.join(restore_dir, source_path))
+    if os.path.commonpath([os.path.abspath(path), os.path.abspath(restore_dir)]) != os.path.abspath(restore_dir):
+        raise ValueError(f"Source path outside the restore directory: {source_path}")
+    return path
+
+def set_mtime(path, modification_time_ns):
+    if modification_time_ns is not None:
+        os.utime(path, ns=(modification_time_ns, modification_time_ns))
+
+def write_targets(source, targets):
+    # Stream a file object into the first (path, modification_time_ns) target and copy that to the rest,
+    # which are duplicates of the same content
+    first = targets[0][0]
+    os.makedirs(os.path.dirname(first), exist_ok=True)
+    with open(first, 'wb') as f:
+        shutil.copyfileobj(source, f, COPY_CHUNK_SIZE)
+    place_copies(first, targets)
+
+def place_copies(first, targets):
+    for path, _ in targets[1:]:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(first, path)
+    for path, modification_time_ns in targets:
+        set_mtime(path, modification_time_ns)
+
+# The extractors take the archive as a path or as a file object, such as a blob download stream
+
+def member_label(member):
+    # How a member shows up in errors; a single-file archive has the None member
+    return member if member is not None else 'the archived file'
+
+def extract_xz(archive, members, work_dir):
+    # A single file compressed as one .xz stream
+    with lzma.open(archive) as source:
+        write_targets(source, members[None])
+
+def extract_tar(archive, members, work_dir):
+    # A .tar.xz pack is read front to back once, in tarfile's stream mode, writing out the wanted members as they go by
+    if isinstance(archive, str):
+        with open(archive, 'rb') as f:
+            return extract_tar(f, members, work_dir)
+    wanted = dict(members)
+    with tarfile.open(fileobj=archive, mode='r|*') as tar:
+        for info in tar:
+            targets = wanted.pop(info.name, None)
+            if targets is not None:
+                write_targets(tar.extractfile(info), targets)
+            if not wanted:
+                break
+    if wanted:
+        raise LookupError(f"Missing from the archive: {', '.join(member_label(member) for member in wanted)}")
+
+def extract_7z(archive, members, work_dir):
+    # A single-file .7z holds the file under its original name, and a pack holds its members under their
+    # paths. They are extracted into a scratch directory and moved into place, with the external 7z when
+    # it is installed and py7zr otherwise. A file object must be seekable and needs py7zr.
+    out_dir = tempfile.mkdtemp(dir=work_dir)
+    try:
+        names = [member for member in members if member is not None]
+        if isinstance(archive, str) and shutil.which('7z'):
+            command = ['7z', 'x', '-y', '-bd', '-scsUTF-8', '-o' + out_dir, os.path.abspath(archive)]
+            if names:
+                # The names go through a list file, as when the pack was written
+                list_path = out_dir + '.lst'
+                with open(list_path, 'w', encoding='utf-8') as f:
+                    f.write('\n'.join(names) + '\n')
+                command.append('@' + list_path)
+            try:
+                subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+            finally:
+                if names:
+                    os.remove(list_path)
+        elif py7zr is not None:
+            with py7zr.SevenZipFile(archive) as seven_zip:
+                seven_zip.extract(out_dir, targets=names or None)
+        else:
+            raise RuntimeError("Extracting .7z archives needs the 7z command or py7zr")
+        
+        for member, targets in members.items():
+            if member is None:
+                extracted = os.path.join(out_dir, (os.listdir(out_dir) or [''])[0])
+            else:
+                extracted = os.path.join(out_dir, member)
+            if not os.path.isfile(extracted):
+                raise LookupError(f"Missing from the archive: {member_label(member)}")
+            os.makedirs(os.path.dirname(targets[0][0]), exist_ok=True)
+            os.replace(extracted, targets[0][0])
+            place_copies(targets[0][0], targets)
+    finally:
+        shutil.rmtree(out_dir)
+
+def zstd_decompressor(dictionary=None):
+    if zstandard is None:
+        raise RuntimeError("Extracting .zst archives needs zstandard")
+    return zstandard.ZstdDecompressor(dict_data=dictionary)
+
+def extract_zstd(archive, members, work_dir, dictionary=None):
+    # A single file compressed as one zstd frame, possibly with the batch's dictionary
+    if isinstance(archive, str):
+        with open(archive, 'rb') as f:
+            return extract_zstd(f, members, work_dir, dictionary)
+    with zstd_decompressor(dictionary).stream_reader(archive, closefd=False) as source:
+        write_targets(source, members[None])
+
+def extract_tar_zstd(archive, members, work_dir):
+    # A tar stream in one zstd frame, read front to back once like a .tar.xz
+    if isinstance(archive, str):
+        with open(archive, 'rb') as f:
+            return extract_tar_zstd(f, members, work_dir)
+    with zstd_decompressor().stream_reader(archive, closefd=False) as source:
+        extract_tar(source, members, work_dir)
+
+# Archive suffixes of packs and of single files, and the functions that restore their
+# members: function(archive, {member_name or None: [(path, modification_time_ns)]}, work_dir).
+# They are kept apart because a single file keeps its own name, so a source file backup.tar
+# is archived as backup.tar.xz or backup.tar.zst, which are pack suffixes.
+PACK_EXTRACTORS = [
+    ('.tar.xz', extract_tar),
+    ('.tar.zst', extract_tar_zstd),
+    ('.7z', extract_7z),
+]
+FILE_EXTRACTORS = [
+    ('.7z', extract_7z),
+    ('.xz', extract_xz),
+    ('.zst', extract_zstd),
+]
+
+def extract_archive(archive, filepath, members, work_dir, dictionary=None):
+    # Records with a member_name are in a pack; a single-file archive has only the None member
+    extractors = FILE_EXTRACTORS if None in members else PACK_EXTRACTORS
+    for suffix, extract in extractors:
+        if filepath.endswith(suffix):
+            if dictionary is not None:
+                # Only zstd archives are written with a dictionary
+                return extract(archive, members, work_dir, dictionary)
+            return extract(archive, members, work_dir)
+    raise ValueError(f"Unknown archive type: {filepath}")
+
+def load_dictionary(cursor, dictionary_id):
+    # The zstd dictionary a file was compressed with, from the catalog's dictionaries table
+    cursor.execute('SELECT data FROM dictionaries WHERE id = ?', (dictionary_id,))
+    row = cursor.fetchone()
+    if row is None:
+        raise LookupError(f"No zstd dictionary {dictionary_id} in the catalog")
+    if zstandard is None:
+        raise RuntimeError("Extracting .zst archives needs zstandard")
+    return zstandard.ZstdCompressionDict(row[0])
+
+class BlobReader(io.RawIOBase):
+    # A seekable, read-only view of a blob that downloads the byte ranges asked for. py7zr reads a .7z's
+    # header at the end before its data, so a download stream will not do for it. Wrapped in a
+    # BufferedReader of STREAM_CHUNK_SIZE, which also bounds the memory it takes.
+    def __init__(self, blob_client):
+        self.blob_client = blob_client
+        self.size = blob_client.get_blob_properties().size
+        self.position = 0
+    
+    def readable(self):
+        return True
+    
+    def seekable(self):
+        return True
+    
+    def tell(self):
+        return self.position
+    
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        else:
+            self.position = self.size + offset
+        return self.position
+    
+    def readinto(self, buffer):
+        length = min(len(buffer), self.size - self.position)
+        if length <= 0:
+            return 0
+        data = self.blob_client.download_blob(offset=self.position, length=length).readall()
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+def can_stream(filepath):
+    # .xz, .zst and their .tar packs decode from a plain download stream; a .7z needs py7zr, as the 7z command only reads files
+    return filepath.endswith(('.xz', '.zst')) or (filepath.endswith('.7z') and py7zr is not None)
+
+def stream_archive(container_client, blob_name, filepath, members, work_dir, max_concurrency, dictionary=None):
+    # Restore from a blob without saving the archive first: only the restored files are written.
+    # Memory stays at a few chunks per stream, whatever the size of the archive.
+    blob_client = container_client.get_blob_client(blob_name)
+    if filepath.endswith('.7z'):
+        with io.BufferedReader(BlobReader(blob_client), STREAM_CHUNK_SIZE) as source:
+            extract_archive(source, filepath, members, work_dir)
+    else:
+        extract_archive(blob_client.download_blob(max_concurrency=max_concurrency), filepath, members, work_dir, dictionary)
+
+def download_archive(container_client, blob_name, local_path, max_concurrency):
+    # Download one blob to local_path; runs on a download thread
+    with open(local_path, 'wb') as f:
+        container_client.get_blob_client(blob_name).download_blob(max_concurrency=max_concurrency).readinto(f)
+    return local_path
+
+def restore(conn, filter_criteria, restore_dir, container_client=None, archive_dir=None, download_workers=8, workers=4, max_concurrency=4):
+    # Restores the matching records under restore_dir at their source paths, with their modification times.
+    # Archives come from the Azure container as <batch>/<filepath>, or from archive_dir, a destination
+    # directory that was kept, as <filepath>. Each archive is fetched once, however many records it holds.
+    # Blobs are decoded as they download where the format allows it, on the download pool; the rest are
+    # downloaded to disk and then extracted on a separate pool. Returns the number of records that failed.
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+    os.makedirs(restore_dir, exist_ok=True)
+    failures = 0
+    
+    # archive (batch, filepath) -> {member_name or None: [(path, modification_time_ns)]}, the zstd dictionary
+    # of each archive that was written with one, and the directories
+    archives = {}
+    archive_dictionaries = {}
+    dictionaries = {}
+    directories = []
+    for record in select_records(conn, filter_criteria):
+        try:
+            path = restore_path(restore_dir, record['source_path'])
+            if record['content_type'] == 'directory':
+                os.makedirs(path, exist_ok=True)
+                directories.append((path, record['modification_time_ns']))
+                continue
+            batch, filepath, member_name = locate_archive(cursor, record)
+            if record['dictionary_id'] is not None:
+                if record['dictionary_id'] not in dictionaries:
+                    dictionaries[record['dictionary_id']] = load_dictionary(cursor, record['dictionary_id'])
+                archive_dictionaries[(batch, filepath)] = dictionaries[record['dictionary_id']]
+            archives.setdefault((batch, filepath), {}).setdefault(member_name, []).append((path, record['modification_time_ns']))
+        except (LookupError, ValueError, RuntimeError) as e:
+            tqdm.write(f"Error restoring {record['source_path']}: {e}")
+            failures += 1
+    
+    # Downloads and extractions use a scratch directory inside restore_dir, so that extracted files can be moved into place
+    work_dir = tempfile.mkdtemp(prefix='.restore-', dir=restore_dir)
+    queue = deque(archives.items())
+    # future -> ((batch, filepath), members, downloaded); only this thread touches the progress bar
+    downloading = {}
+    extracting = {}
+    
+    def count_failure(members):
+        return sum(len(targets) for targets in members.values())
+    
+    try:
+        with tqdm(total=len(archives), desc="Restoring archives", unit="archive") as pbar, \
+             ThreadPoolExecutor(max_workers=download_workers) as downloads, ThreadPoolExecutor(max_workers=workers) as extractions:
+            while queue or downloading or extracting:
+                # A bounded window of archives, so that downloads do not run far ahead of extraction
+                while queue and len(downloading) + len(extracting) < (download_workers + workers) * 2:
+                    (batch, filepath), members = queue.popleft()
+                    if archive_dir is not None:
+                        future = downloads.submit(os.path.join, archive_dir, filepath)
+                        downloading[future] = ((batch, filepath), members, False)
+                    elif can_stream(filepath):
+                        future = downloads.submit(stream_archive, container_client, batch + '/' + filepath, filepath, members, work_dir, max_concurrency,
+                                                  archive_dictionaries.get((batch, filepath)))
+                        extracting[future] = ((batch, filepath), members, False)
+                    else:
+                        local_path = os.path.join(work_dir, str(uuid.uuid4()))
+                        future = downloads.submit(download_archive, container_client, batch + '/' + filepath, local_path, max_concurrency)
+                        downloading[future] = ((batch, filepath), members, True)
+                
+                done = wait(list(downloading) + list(extracting), return_when=FIRST_COMPLETED).done
+                for future in done:
+                    if future in downloading:
+                        (batch, filepath), members, downloaded = downloading.pop(future)
+                        try:
+                            archive_path = future.result()
+                        except Exception as e:
+                            tqdm.write(f"Error downloading {batch}/{filepath}: {e}")
+                            failures += count_failure(members)
+                            pbar.update(1)
+                            continue
+                        extracting[extractions.submit(extract_archive, archive_path, filepath, members, work_dir, archive_dictionaries.get((batch, filepath)))] = \
+                            ((batch, filepath), members, downloaded and archive_path)
+                    else:
+                        (batch, filepath), members, staged_path = extracting.pop(future)
+                        try:
+                            future.result()
+                        except Exception as e:
+                            tqdm.write(f"Error extracting {batch}/{filepath}: {e}")
+                            failures += count_failure(members)
+                        if staged_path:
+                            os.remove(staged_path)
+                        pbar.update(1)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    
+    # Directory times last, deepest first, since restoring their contents changed them
+    for path, modification_time_ns in sorted(directories, key=lambda item: item[0].count(os.sep), reverse=True):
+        set_mtime(path, modification_time_ns)
+    return failures
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Restore archived files recorded in the database.")
+    parser.add_argument("--db_path", help="Path to the SQLite database file",
+                        default=os.getenv('DB_PATH'))
+    parser.add_argument("--restore_directory", help="Directory to restore the files into", required=True)
+    parser.add_argument("--archive_directory", help="Read archives from this kept destination directory instead of Azure")
+    parser.add_argument("--azure_container", help="Azure Blob Storage container name",
+                        default=os.getenv('AZURE_CONTAINER'))
+    parser.add_argument("--azure_connection_string", help="Azure Blob Storage connection string",
+                        default=os.getenv('AZURE_CONNECTION_STRING'))
+    parser.add_argument("--download_workers", type=int, help="Number of blobs downloaded concurrently",
+                        default=int(os.getenv('DOWNLOAD_WORKERS', '8')))
+    parser.add_argument("--workers", type=int, help="Number of archives extracted concurrently",
+                        default=int(os.getenv('WORKERS', os.cpu_count() or 1)))
+    parser.add_argument("--max_concurrency", type=int, help="Parallel range requests within one large blob",
+                        default=int(os.getenv('MAX_CONCURRENCY', '4')))
+    parser.add_argument("--batch", help="Only records from this batch")
+    parser.add_argument("--source_prefix", help="Only records whose source path starts with this")
+    parser.add_argument("--filename", help="Filter by filename")
+    parser.add_argument("--content_type", help="Filter by content type")
+    parser.add_argument("--size_gt", type=parse_size, help="Larger than this size")
+    parser.add_argument("--size_lt", type=parse_size, help="Smaller than this size")
+    parser.add_argument("--mtime_between", nargs=2, type=parse_time, metavar=("START", "END"),
+                        help="Modified at or after START and before END, as ISO dates or timestamps")
+    
+    args = parser.parse_args()
+    
+    filter_criteria = {key: value for key, value in vars(args).items()
+                       if key in ("batch", "source_prefix", "filename", "content_type", "size_gt", "size_lt", "mtime_between") and value is not None}
+    
+    container_client = None
+    if args.archive_directory is None:
+        if not (args.azure_container and args.azure_connection_string):
+            parser.error("either --archive_directory or an Azure container and connection string is needed")
+        container_client = BlobServiceClient.from_connection_string(args.azure_connection_string).get_container_client(args.azure_container)
+    
+    start_time = datetime.now()
+    print(f"Process started at: {start_time}")
+    
+    conn = sqlite3.connect(args.db_path)
+    try:
+        failures = restore(conn, filter_criteria, args.restore_directory, container_client, args.archive_directory,
+                           args.download_workers, args.workers, args.max_concurrency)
+    finally:
+        conn.close()
+    
+    end_time = datetime.now()
+    print(f"Process ended at: {end_time}")
+    print(f"Total duration: {end_time - start_time}")
+    print(f"Files restored to: {args.restore_directory}")
+    if failures:
+        print(f"Files not restored: {failures}")
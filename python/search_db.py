@@ -1,5 +1,7 @@
 import sqlite3
 import argparse
+import json
+from datetime import datetime
 
 def format_size(size):
     # Convert size to human-readable format
@@ -8,54 +10,175 @@ def format_size(size):
             return f"{size:.2f} {unit}"
         size /= 1024
 
-def search_database(db_path, filter_criteria):
+def parse_size(text):
+    # Bytes, or a number with one of the units that format_size prints, e.g. 10MB or 1.5 GB
+    text = text.strip().upper()
+    for exponent, unit in reversed(list(enumerate(['B', 'KB', 'MB', 'GB', 'TB']))):
+        if text.endswith(unit):
+            return int(float(text[:-len(unit)]) * 1024 ** exponent)
+    return int(text)
+
+def parse_time(text):
+    # An ISO date or date and time in local time, as nanoseconds since the epoch like the catalog's *_ns columns
+    moment = datetime.fromisoformat(text)
+    return int(moment.replace(microsecond=0).timestamp()) * 1000000000 + moment.microsecond * 1000
+
+def prefix_range(prefix):
+    # The half-open range [prefix, upper) holds every string that starts with prefix. Unlike LIKE 'prefix%'
+    # it can use an index.
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+# Filters matched as substrings with LIKE '%value%'; these scan the catalog
+LIKE_FILTERS = ('filename', 'filepath', 'content_type', 'creation_time', 'modification_time')
+
+def compile_filters(filter_criteria):
+    # Turns filter_criteria into WHERE conditions and their values. Besides the LIKE_FILTERS, the typed filters are
+    # size, size_gt and size_lt (bytes), mtime_between and ctime_between ((start, end) pairs of nanosecond timestamps,
+    # end excluded), batch, duplicates_only and source_prefix. All but duplicates_only are answered from indexes.
+    conditions = []
+    values = []
+    for key, value in filter_criteria.items():
+        if key in LIKE_FILTERS:
+            conditions.append(f"files.{key} LIKE ?")
+            values.append(f"%{value}%")
+        elif key == 'size':
+            conditions.append("files.size = ?")
+            values.append(value)
+        elif key == 'size_gt':
+            conditions.append("files.size > ?")
+            values.append(value)
+        elif key == 'size_lt':
+            conditions.append("files.size < ?")
+            values.append(value)
+        elif key == 'mtime_between':
+            conditions.append("files.modification_time_ns >= ? AND files.modification_time_ns < ?")
+            values.extend(value)
+        elif key == 'ctime_between':
+            conditions.append("files.creation_time_ns >= ? AND files.creation_time_ns < ?")
+            values.extend(value)
+        elif key == 'batch':
+            conditions.append("files.batch = ?")
+            values.append(value)
+        elif key == 'duplicates_only':
+            if value:
+                conditions.append("files.is_duplicate = 1")
+        elif key == 'source_prefix':
+            if value:
+                conditions.append("files.source_path >= ? AND files.source_path < ?")
+                values.extend(prefix_range(value))
+        else:
+            raise ValueError(f"Unknown filter: {key}")
+    return conditions, values
+
+def iter_search(db_path, filter_criteria, fts_query=None, limit=None, offset=0, after=None, page_size=1000):
+    # Yields (id, filename, content_type, size, filepath, batch) rows ordered by (batch, filepath, id), fetching
+    # page_size rows at a time so that memory stays flat however many rows match. filter_criteria is compiled
+    # by compile_filters. fts_query is an FTS5 query on filename and filepath
+    # (tokens, prefixes such as report*, "quoted phrases", filename:svg), answered from the files_fts index
+    # instead of a scan of the whole catalog. after is the (batch, filepath, id) of the last row already seen,
+    # to continue a listing where it left off without counting through the rows before it like offset does.
     conn = sqlite3.connect(db_path)
     cursor = conn.cursor()
     
-    # Select only the required columns in the desired order
-    query = "SELECT id, filename, content_type, size, filepath, thumbnail FROM files WHERE "
-    query += " AND ".join([f"{key} LIKE ?" for key in filter_criteria.keys()])
-    values = [f"%{value}%" for value in filter_criteria.values()]
+    # Select only the required columns in the desired order; thumbnails are loaded on request with load_thumbnail
+    query = "SELECT files.id, files.filename, files.content_type, files.size, files.filepath, files.batch FROM files"
+    conditions, values = compile_filters(filter_criteria)
+    if fts_query is not None:
+        query += " JOIN files_fts ON files_fts.rowid = files.rowid"
+        conditions.insert(0, "files_fts MATCH ?")
+        values.insert(0, fts_query)
+    if after is not None:
+        conditions.append("(files.batch, files.filepath, files.id) > (?, ?, ?)")
+        values.extend(after)
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    # The id breaks ties between the members of a pack, which share a filepath
+    query += " ORDER BY files.batch, files.filepath, files.id"
+    if limit is not None or offset:
+        query += " LIMIT ? OFFSET ?"
+        values.extend([-1 if limit is None else limit, offset])
     
-    cursor.execute(query, values)
-    results = cursor.fetchall()
+    try:
+        cursor.execute(query, values)
+        while True:
+            rows = cursor.fetchmany(page_size)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        conn.close()
+
+def check_fts_query(db_path, fts_query):
+    # Runs fts_query on its own, so that a malformed query, a column other than filename and filepath, or a
+    # catalog without files_fts raises sqlite3.OperationalError before any row of a search is printed
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute("SELECT rowid FROM files_fts WHERE files_fts MATCH ? LIMIT 1", (fts_query,)).fetchall()
+    finally:
+        conn.close()
+
+def search_database(db_path, filter_criteria, fts_query=None):
+    return list(iter_search(db_path, filter_criteria, fts_query))
+
+def load_thumbnail(db_path, file_id):
+    # Returns (format, width, height, data) for a file's thumbnail, or None if it has none
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    
+    cursor.execute("SELECT format, width, height, data FROM thumbnails WHERE file_id = ?", (file_id,))
+    thumbnail = cursor.fetchone()
     
     conn.close()
-    return results
+    return thumbnail
 
 if __name__ == "__main__":
-    # Temporarily set db_path and filter criteria for debugging
-    db_path = r"C:\Temp\directory_tree.db"
-    filter_criteria = {"filename": "%svg%"}  # Match filenames ending with 'svg'
+    parser = argparse.ArgumentParser(description="Search the database for records matching the filter criteria.")
+    parser.add_argument("db_path", help="Path to the SQLite database file")
+    parser.add_argument("--fts", help="Full-text query on filename and filepath, e.g. 'holiday*', '\"annual report\"' or 'filename:svg'")
+    parser.add_argument("--filename", help="Filter by filename")
+    parser.add_argument("--filepath", help="Filter by filepath")
+    parser.add_argument("--content_type", help="Filter by content type")
+    parser.add_argument("--size", type=parse_size, help="Exact size, in bytes or with a unit such as 10MB")
+    parser.add_argument("--size_gt", type=parse_size, help="Larger than this size")
+    parser.add_argument("--size_lt", type=parse_size, help="Smaller than this size")
+    parser.add_argument("--creation_time", help="Filter by creation time")
+    parser.add_argument("--modification_time", help="Filter by modification time")
+    parser.add_argument("--mtime_between", nargs=2, type=parse_time, metavar=("START", "END"),
+                        help="Modified at or after START and before END, as ISO dates or timestamps")
+    parser.add_argument("--ctime_between", nargs=2, type=parse_time, metavar=("START", "END"),
+                        help="Created at or after START and before END, as ISO dates or timestamps")
+    parser.add_argument("--batch", help="Only records from this batch")
+    parser.add_argument("--duplicates_only", action="store_true", help="Only records that duplicate an earlier file")
+    parser.add_argument("--source_prefix", help="Only records whose source path starts with this")
+    parser.add_argument("--limit", type=int, help="Print at most this many rows")
+    parser.add_argument("--offset", type=int, default=0, help="Skip this many rows first")
+    parser.add_argument("--after", nargs=3, metavar=("BATCH", "FILEPATH", "ID"),
+                        help="Continue after this row, as printed last by the previous page")
+    parser.add_argument("--format", choices=["tsv", "jsonl"], default="tsv", help="Output format")
+    
+    args = parser.parse_args()
+    
+    # Options left unset are None, except --duplicates_only, which is False and which compile_filters skips.
+    # A value of 0, as in --size 0, is a filter like any other.
+    filter_criteria = {key: value for key, value in vars(args).items()
+                       if key not in ("db_path", "fts", "limit", "offset", "after", "format") and value is not None}
+    
+    if args.fts is not None:
+        try:
+            check_fts_query(args.db_path, args.fts)
+        except sqlite3.OperationalError as e:
+            if 'no such table' in str(e):
+                parser.error(f"{args.db_path} has no full-text index; archive_dir.py builds it when its SQLite has FTS5")
+            parser.error(f"invalid --fts query {args.fts!r}: {e}. Quote terms that contain punctuation, e.g. '\"a/b\"', "
+                         "and use only the filename: and filepath: columns")
     
-    results = search_database(db_path, filter_criteria)
+    results = iter_search(args.db_path, filter_criteria, args.fts, args.limit, args.offset, args.after)
     
-    # Print rows
+    # Print rows as they arrive
     for row in results:
-        row = list(row)
-        row[3] = format_size(row[3])  # Format the size column
-        row[5] = format_size(len(row[5])) if row[5] else "No thumbnail"  # Show the blob size or indicate if no thumbnail exists
-        print("\t".join(map(str, row)))
-    
-    # Uncomment the following lines to use command-line arguments instead
-    # parser = argparse.ArgumentParser(description="Search the database for records matching the filter criteria.")
-    # parser.add_argument("db_path", help="Path to the SQLite database file")
-    # parser.add_argument("--filename", help="Filter by filename")
-    # parser.add_argument("--filepath", help="Filter by filepath")
-    # parser.add_argument("--content_type", help="Filter by content type")
-    # parser.add_argument("--size", help="Filter by size")
-    # parser.add_argument("--creation_time", help="Filter by creation time")
-    # parser.add_argument("--modification_time", help="Filter by modification time")
-    
-    # args = parser.parse_args()
-    
-    # filter_criteria = {key: value for key, value in vars(args).items() if key != "db_path" and value is not None}
-    
-    # results = search_database(args.db_path, filter_criteria)
-    
-    # Print rows
-    # for row in results:
-    #     row = list(row)
-    #     row[3] = format_size(row[3])  # Format the size column
-    #     row[5] = format_size(len(row[5])) if row[5] else "No thumbnail"  # Show the blob size or indicate if no thumbnail exists
-    #     print("\t".join(map(str, row)))
\ No newline at end of file
+        if args.format == "jsonl":
+            print(json.dumps(dict(zip(("id", "filename", "content_type", "size", "filepath", "batch"), row))))
+        else:
+            row = list(row)
+            row[3] = format_size(row[3])  # Format the size column
+            print("\t".join(map(str, row)))